@@ -58,6 +58,12 @@ class MZMSettings(settings.Group):
         Alternatively, set it to a path to a program to open the .gba file with
         """
 
+    class CompressionCache(settings.Bool):
+        """
+        Set this to false to not keep graphics and tilemaps compressed while patching in the Archipelago cache
+        directory, where they are reused to patch later seeds faster
+        """
+
     class TrackerSettings(settings.Group):
         class TrickLogic(StrEnum):
             """
@@ -73,6 +79,7 @@ class MZMSettings(settings.Group):
 
     rom_file: RomFile = RomFile(RomFile.copy_to)
     rom_start: typing.Union[RomStart, bool] = True
+    compression_cache: typing.Union[CompressionCache, bool] = True
     universal_tracker_setings: TrackerSettings = TrackerSettings()
 
 class MZMWeb(WebWorld):
@@ -15,7 +15,7 @@ from worlds.Files import APPatchExtension, APProcedurePatch
 from .items import item_data_table, tank_data_table, major_item_data_table
 from .locations import full_location_table as location_table
 from .options import ChozodiaAccess, DisplayNonLocalItems, Goal, LayoutPatches
-from .patcher import MD5_US, patch_rom
+from .patcher import MD5_US, compression, patch_rom, patch_rom_to_file
 from .patcher.text import LINE_WIDTH, SPACE, Message, get_width_of_encoded_character
 from .item_sprites import Sprite, get_zero_mission_sprite, unknown_item_alt_sprites
 
@@ -28,6 +28,7 @@ class MZMPatchExtensions(APPatchExtension):
 
     @staticmethod
     def apply_json(caller: APProcedurePatch, rom: bytes, file_name: str) -> bytes:
+        configure_compression_cache()
         return patch_rom(rom, json.loads(caller.get_file(file_name).decode()))
 
 
@@ -37,12 +38,33 @@ class MZMProcedurePatch(APProcedurePatch):
     patch_file_ending = ".apmzm"
     result_file_ending = ".gba"
     procedure = [("apply_json", ["patch.json"])]
+    # Set while patch() runs the base implementation, which reads the patch file that patch() has already read
+    _already_read = False
 
     @classmethod
     def get_source_data(cls) -> bytes:
         with open(get_base_rom_path(), "rb") as stream:
             return stream.read()
 
+    def read(self, *args, **kwargs) -> None:
+        if not self._already_read:
+            super().read(*args, **kwargs)
+
+    def patch(self, target: str) -> None:
+        # A procedure that only applies a JSON patch is run by patching the ROM in the target file instead of copying
+        # it there. Any other procedure from the patch file's manifest is run as usual
+        self.read()
+        if len(self.procedure) != 1 or self.procedure[0][0] != "apply_json":
+            self._already_read = True
+            try:
+                super().patch(target)
+            finally:
+                self._already_read = False
+            return
+        (_, (file_name,)), = self.procedure
+        configure_compression_cache()
+        patch_rom_to_file(self.get_source_data_with_cache(), json.loads(self.get_file(file_name).decode()), target)
+
 
 def get_base_rom_path(file_name: str = "") -> Path:
     from . import MZMWorld
@@ -56,6 +78,14 @@ def get_base_rom_path(file_name: str = "") -> Path:
         return Path(Utils.user_path(file_name))
 
 
+def configure_compression_cache():
+    from . import MZMWorld
+    if MZMWorld.settings.compression_cache:
+        compression.cache.directory = Path(Utils.cache_path("mzm", "compression"))
+    else:
+        compression.cache.directory = None
+
+
 goal_texts = {
     Goal.option_mecha_ridley: "Infiltrate and destroy\nthe Space Pirates' mother ship.",
     Goal.option_bosses: "Exterminate all Metroid\norganisms and defeat Mother Brain.",
@@ -3,19 +3,21 @@ from __future__ import annotations
 from enum import StrEnum
 import hashlib
 import logging
+from os import PathLike
+from pathlib import Path
 import pkgutil
 import struct
 from typing import Literal, NotRequired, TypedDict
 
 import bsdiff4
 
-from . import lz10
 from .backgrounds import fix_crateria_door_locks, patch_chozodia_spotlight, write_item_clipdata_and_gfx
+from .compression import compress_lz10_parts_to_fit, recompress_lz10_to_fit
 from .connections import apply_connections
 from .constants import RC_COUNT, PIXEL_SIZE, Area, Event, ItemType
 from .items import item_data_table
 from .layout_patches import apply_layout_patches
-from .local_rom import LocalRom, get_rom_address
+from .local_rom import LocalRom, get_rom_address, get_struct
 from .sprites import builtin_sprite_pointers, sprite_imports, write_decompressed_item_sprites
 from .symbols import get_symbol
 from .text import NEWLINE, TERMINATOR_CHAR, Message, make_item_message
@@ -85,6 +87,9 @@ DIFFICULTY_MAPPING = {
 
 RUINS_TEST_LOCATION_ID = 100
 
+# Type, whether it was obtained, bits, sprite, message, sound, acquisition, whether the message is one line
+PLACED_ITEM = get_struct("<BBHIIHBB")
+
 
 # TODO: Support overriding more text
 TEXT_INDICES = {
@@ -98,7 +103,35 @@ TEXT_INDICES = {
 
 def patch_rom(data: bytes, patch: PatchJson) -> bytes:
     rom = LocalRom(apply_basepatch(data))
+    apply_patch(rom, patch)
+    return rom.to_bytes()
+
+
+def patch_rom_to_file(data: bytes, patch: PatchJson, path: str | PathLike[str]):
+    """Like patch_rom(), but patches the ROM in the file it is saved to instead of in memory."""
+    with LocalRom.open_output(path, apply_basepatch(data)) as rom:
+        apply_patch(rom, patch)
+
+
+def write_basepatched_rom(data: bytes, path: str | PathLike[str]):
+    """Apply the basepatch to a vanilla ROM and save it, so that several seeds can be patched from it at once."""
+    Path(path).write_bytes(apply_basepatch(data))
+
+
+def patch_basepatched_rom(path: str | PathLike[str], patch: PatchJson, delta: bool = False) -> bytes:
+    """
+    Like patch_rom(), but for a ROM saved by write_basepatched_rom(). The file is mapped copy-on-write, so patching
+    from it only copies the parts of the ROM that are changed. If `delta` is set, returns an IPS patch to apply to the
+    basepatched ROM instead of the patched ROM.
+    """
+    with LocalRom.copy_on_write(path) as rom:
+        apply_patch(rom, patch)
+        if delta:
+            return rom.to_ips()
+        return rom.to_bytes()
+
 
+def apply_patch(rom: LocalRom, patch: PatchJson):
     write_seed_config(rom, patch)
 
     write_decompressed_item_sprites(rom)
@@ -116,7 +149,7 @@ def patch_rom(data: bytes, patch: PatchJson) -> bytes:
 
     write_text(rom, patch.get("text", {}))
 
-    return rom.to_bytes()
+    logging.debug(f"Extra ROM space: {rom.space_report()}")
 
 
 def apply_basepatch(rom: bytes) -> bytes:
@@ -154,7 +187,7 @@ def write_seed_config(rom: LocalRom, patch: PatchJson):
 
         config.get("metroid_dna_required", 5) if goal == "metroid_dna" else 0,
     )
-    rom.write(get_rom_address("sRandoSeed"), struct.pack("<64s64s12B", *seed_info))
+    rom.write_struct("<64s64s12B", get_rom_address("sRandoSeed"), *seed_info)
 
     if goal != "vanilla":
         if goal == "bosses":
@@ -165,14 +198,11 @@ def write_seed_config(rom: LocalRom, patch: PatchJson):
         else:
             raise ValueError(f"Invalid goal: {goal}")
 
-        rom.write(
-            get_rom_address("sHatchLockEventsChozodia", 8 * 15 + 1),  # sHatchLockEventsChozodia[15].event
-            struct.pack("<B", event)
-        )
-        rom.write(get_rom_address("sNumberOfHatchLockEventsPerArea", 2 * Area.CHOZODIA), struct.pack("<H", 16))
+        rom.write_u8(get_rom_address("sHatchLockEventsChozodia", 8 * 15 + 1), event)  # sHatchLockEventsChozodia[15].event
+        rom.write_u16(get_rom_address("sNumberOfHatchLockEventsPerArea", 2 * Area.CHOZODIA), 16)
 
     if config.get("chozodia_requires_mother_brain", False):
-        rom.write(get_rom_address("sNumberOfHatchLockEventsPerArea", 2 * Area.CRATERIA), struct.pack("<H", 4))
+        rom.write_u16(get_rom_address("sNumberOfHatchLockEventsPerArea", 2 * Area.CRATERIA), 4)
 
     if config.get("reveal_maps"):
         rom.write(get_rom_address("sMinimapTilesPal"), pkgutil.get_data(__name__, "data/pause_screen/revealed_map_tile.pal"))
@@ -184,52 +214,45 @@ def _make_tile_bytes(tile_id: int, palette: int, hflip=False, vflip=False):
 
 def write_metroid_dna_status_screen_patch(rom: LocalRom):
     def get_frame_address(animation_index, frame_number) -> int:
-        frame_data_ptr, = rom.read(get_rom_address("sPauseScreenMiscOam", 8 * animation_index), "<I")
+        frame_data_ptr = rom.read_u32(get_rom_address("sPauseScreenMiscOam", 8 * animation_index))
         return get_rom_address(frame_data_ptr, 8 * frame_number)
 
     def shift_sprite(array_address, index, x_amount):
         sprite_address = array_address + 2 * (1 + 3 * index)
-        attr1, = rom.read(sprite_address + 2, "<H")
+        attr1 = rom.read_u16(sprite_address + 2)
         x = ((attr1 & 0x1FF) + x_amount) & 0x1FF
         attr1 = (attr1 & 0xFE00) | x
-        rom.write(sprite_address + 2, struct.pack("<H", attr1))
+        rom.write_u16(sprite_address + 2, attr1)
 
     # Add DNA header
-    frame_data = struct.pack("<I", get_symbol("sRandoOam_EnergyDNAHeader"))
-    rom.write(get_frame_address(23, 0), frame_data)
+    rom.write_u32(get_frame_address(23, 0), get_symbol("sRandoOam_EnergyDNAHeader"))
 
     # Shift bomb category pointer graphic
     for i, frame_count in enumerate([1, 2, 2, 3, 2, 3, 4, 5, 2]):
-        oam_ptr, = rom.read(get_frame_address(33, i), "<I")
+        oam_ptr = rom.read_u32(get_frame_address(33, i))
         oam_addr = get_rom_address(oam_ptr)
         for j in range(frame_count):
             shift_sprite(oam_addr, j, 1)
-    oam_ptr, = rom.read(get_frame_address(33, 8), "<I")
+    oam_ptr = rom.read_u32(get_frame_address(33, 8))
     shift_sprite(get_rom_address(oam_ptr), 3, 1)
 
+    # Edited graphics and tilemaps, which are all compressed at the end, and the sizes of their original buffers
+    edited_assets: dict[str, tuple[bytearray, int]] = {}
+
     # Add sprite tiles
-    sprites_gfx = rom.decompress_lzss(get_rom_address("sTankIconsGfx"))
-    edited_gfx = bytearray(sprites_gfx)
+    edited_gfx = rom.decompress_lzss_mutable(get_rom_address("sTankIconsGfx"))
     edited_gfx[0x29C0:0x2A80] = bytes(64) + pkgutil.get_data(__name__, "data/pause_screen/dna_bar_sprite.gfx")
-    edited_gfx = lz10.compress(edited_gfx)
-    assert len(edited_gfx) <= 4 * (1786 + 11)
-    rom.write(get_rom_address("sTankIconsGfx"), edited_gfx)
+    edited_assets["sTankIconsGfx"] = (edited_gfx, 4 * (1786 + 11))
 
     # Add background tiles
-    wireframe_bg_gfx = rom.decompress_lzss(get_rom_address("sMotifBehindWireframeSamusGfx"))
-    edited_gfx = bytearray(wireframe_bg_gfx)
+    edited_gfx = rom.decompress_lzss_mutable(get_rom_address("sMotifBehindWireframeSamusGfx"))
     edited_gfx[0x40:0xA0] = pkgutil.get_data(__name__, "data/pause_screen/dna_icon_bottom.gfx")
     edited_gfx[0x100:0x140] = pkgutil.get_data(__name__, "data/pause_screen/dna_bar_extension.gfx")
-    edited_gfx = lz10.compress(edited_gfx)
-    assert len(edited_gfx) <= 4 * (278 + 7)
-    rom.write(get_rom_address("sMotifBehindWireframeSamusGfx"), edited_gfx)
+    edited_assets["sMotifBehindWireframeSamusGfx"] = (edited_gfx, 4 * (278 + 7))
 
-    pause_screen_gfx = rom.decompress_lzss(get_rom_address("sPauseScreenHudGfx"))
-    edited_gfx = bytearray(pause_screen_gfx)
+    edited_gfx = rom.decompress_lzss_mutable(get_rom_address("sPauseScreenHudGfx"))
     edited_gfx[0x4E60:0x4EC0] = pkgutil.get_data(__name__, "data/pause_screen/dna_icon_top.gfx")
-    edited_gfx = lz10.compress(edited_gfx)
-    assert len(edited_gfx) <= 4 * 1404
-    rom.write(get_rom_address("sPauseScreenHudGfx"), edited_gfx)
+    edited_assets["sPauseScreenHudGfx"] = (edited_gfx, 4 * 1404)
 
     # Copy color to unused spot in background palette
     rom.write(get_rom_address("sPauseScreen_3fcef0", 2 * (6 * 16 + 15)), (0x797F).to_bytes(2, "little"))
@@ -239,8 +262,7 @@ def write_metroid_dna_status_screen_patch(rom: LocalRom):
     slash_tile = _make_tile_bytes(748, 11)
 
     def patch_tilemap(symbol: str, length: int):
-        tilemap = rom.decompress_lzss(get_rom_address(symbol))
-        edited_tilemap = bytearray(tilemap)
+        edited_tilemap = rom.decompress_lzss_mutable(get_rom_address(symbol))
         edited_tilemap[0x58:0x5A] = _make_tile_bytes(757, 11)
         edited_tilemap[0x84:0xA4] = (
             4 * grid_tile + slash_tile + 4 * grid_tile +
@@ -252,13 +274,17 @@ def write_metroid_dna_status_screen_patch(rom: LocalRom):
             edited_tilemap[tile:tile + 2] = _make_tile_bytes(2 + i, 11)
         for i, tile in enumerate(range(0xE0, 0xE4, 2)):
             edited_tilemap[tile:tile + 2] = _make_tile_bytes(8 + i, 11)
-        edited_tilemap = lz10.compress(edited_tilemap)
-        assert len(edited_tilemap) <= length
-        rom.write(get_rom_address(symbol), edited_tilemap)
+        edited_assets[symbol] = (edited_tilemap, length)
 
     patch_tilemap("sStatusScreenTilemap", 4 * 264)
     patch_tilemap("sStatusScreenBackgroundTilemap", 4 * 169)
 
+    for symbol, (data, length) in edited_assets.items():
+        address = get_rom_address(symbol)
+        compressed = recompress_lz10_to_fit(rom.view(address), data, length)
+        assert len(compressed) <= length
+        rom.write(address, compressed)
+
     # Shift energy text position
     rom.write(get_rom_address("sStatusScreenGroupsPositions", 5 * 5 + 2), bytes([2, 5]))
     rom.write(get_rom_address("sStatusScreenGroupsPositions", 5 * 6 + 2), bytes([7, 10]))
@@ -270,7 +296,7 @@ def place_items(rom: LocalRom, locations: list[Location]):
         if (first_line, second_line) in message_pointers:
             return message_pointers[(first_line, second_line)]
         message_bytes = make_item_message(first_line, second_line).to_bytes()
-        message_ptr = rom.append(message_bytes)
+        message_ptr = rom.append(message_bytes, dedup=True)
         message_pointers[(first_line, second_line)] = message_ptr
         return message_ptr
 
@@ -279,7 +305,7 @@ def place_items(rom: LocalRom, locations: list[Location]):
         if name in file_pointers:
             return file_pointers[name]
         file_bytes = pkgutil.get_data(__name__, f"data/item_sprites/{name}")
-        file_ptr = rom.append(file_bytes)
+        file_ptr = rom.append(file_bytes, dedup=True)
         file_pointers[name] = file_ptr
         return file_ptr
 
@@ -291,11 +317,11 @@ def place_items(rom: LocalRom, locations: list[Location]):
         gfx_pointer = gfx if type(gfx) is int else get_or_insert_file(gfx)
         pal_pointer = pal if type(pal) is int else get_or_insert_file(pal)
         sprite = struct.pack("<II", gfx_pointer, pal_pointer)
-        sprite_ptr = rom.append(sprite)
+        sprite_ptr = rom.append(sprite, dedup=True)
         sprite_pointers[name] = sprite_ptr
         return sprite_ptr
 
-    placed_items: set[int] = set()
+    placed_items = rom.table(PLACED_ITEM, get_rom_address("sPlacedItems"), RC_COUNT)
     for location in locations:
         location_id = location["id"]
         if location_id >= RC_COUNT or location_id < 0:
@@ -317,29 +343,21 @@ def place_items(rom: LocalRom, locations: list[Location]):
             one_line = len(message_lines) <= 1
             message_pointer = get_or_insert_message(*message_lines)
         sound = 0x4A if location_id == RUINS_TEST_LOCATION_ID else item_data.sound
-        rom.write(
-            get_rom_address("sPlacedItems", 16 * location_id),
-            struct.pack(
-                "<BBHIIHBB",
-                item_data.type, False, item_data.bits,
-                sprite_pointer,
-                message_pointer, sound, item_data.acquisition, one_line
-            )
+        placed_items[location_id] = (
+            item_data.type, False, item_data.bits,
+            sprite_pointer,
+            message_pointer, sound, item_data.acquisition, one_line
         )
-        placed_items.add(location_id)
-
-    for i in range(RC_COUNT):
-        if i not in placed_items:
-            item_data = item_data_table["Nothing"]
-            rom.write(
-                get_rom_address("sPlacedItems", 16 * i),
-                struct.pack(
-                    "<BBHIIHBB",
-                    item_data.type, False, item_data.bits,
-                    get_or_insert_sprite(item_data.sprite),
-                    get_or_insert_message(item_data.message), item_data.sound, item_data.acquisition, True
-                )
-            )
+
+    # Locations without an item get nothing
+    if not placed_items.is_full():
+        item_data = item_data_table["Nothing"]
+        placed_items.fill(
+            item_data.type, False, item_data.bits,
+            get_or_insert_sprite(item_data.sprite),
+            get_or_insert_message(item_data.message), item_data.sound, item_data.acquisition, True
+        )
+    placed_items.write()
 
 
 def write_start_inventory(rom: LocalRom, start_inventory: dict[str, int | bool]):
@@ -357,23 +375,23 @@ def write_start_inventory(rom: LocalRom, start_inventory: dict[str, int | bool])
             custom |= item_data.bits
         elif item_data.type <= ItemType.POWER_BOMB_TANK:
             pickups[item_data.type - 1] = value
-    rom.write(
-        get_rom_address("sRandoStartingInventory"),
-        struct.pack("<BxHBBBBB", *pickups, beams, misc, custom)
-    )
+    rom.write_struct("<BxHBBBBB", get_rom_address("sRandoStartingInventory"), *pickups, beams, misc, custom)
 
 
 def get_message_table_address(rom: LocalRom, group: MessageGroup) -> int:
-    data_table, = rom.read(get_rom_address(f"s{group}TextPointers") + 4 * LANGUAGE_ENGLISH, "<I")
+    data_table = rom.read_u32(get_rom_address(f"s{group}TextPointers") + 4 * LANGUAGE_ENGLISH)
     return data_table
 
 
 def write_warp_to_start_cosmetics(rom: LocalRom):
-    menu_names = rom.decompress_lzss(get_rom_address("sMenuNamesEnglishGfx"))
-    edited_menu_names = lz10.compress(menu_names[:0x20] +
-                                      pkgutil.get_data(__name__, "data/pause_screen/warp.gfx") +
-                                      menu_names[0x80:])
-    assert len(edited_menu_names) <= len(menu_names)
+    # Size of the original compressed graphics
+    menu_names_size = 4 * 92
+    menu_names = memoryview(rom.decompress_lzss_mutable(get_rom_address("sMenuNamesEnglishGfx")))
+    edited_menu_names = compress_lz10_parts_to_fit((menu_names[:0x20],
+                                                    pkgutil.get_data(__name__, "data/pause_screen/warp.gfx"),
+                                                    menu_names[0x80:]),
+                                                   menu_names_size)
+    assert len(edited_menu_names) <= menu_names_size
     rom.write(get_rom_address("sMenuNamesEnglishGfx"), edited_menu_names)
 
     warp_to_start_text = [Message(line).center_align() for line in [
@@ -384,12 +402,10 @@ def write_warp_to_start_cosmetics(rom: LocalRom):
     ]]
     line_1 = warp_to_start_text[0].append(NEWLINE) + warp_to_start_text[1].append(TERMINATOR_CHAR)
     line_2 = warp_to_start_text[2].append(NEWLINE) + warp_to_start_text[3].append(TERMINATOR_CHAR)
-    line_1_ptr = rom.append(line_1.to_bytes())
-    line_2_ptr = rom.append(line_2.to_bytes())
-    rom.write(
-        get_rom_address(get_message_table_address(rom, MessageGroup.MESSAGE), 4 * 36),
-        struct.pack("<II", line_1_ptr, line_2_ptr)
-    )
+    line_1_ptr = rom.append(line_1.to_bytes(), dedup=True)
+    line_2_ptr = rom.append(line_2.to_bytes(), dedup=True)
+    rom.write_struct("<II", get_rom_address(get_message_table_address(rom, MessageGroup.MESSAGE), 4 * 36),
+                     line_1_ptr, line_2_ptr)
 
 
 def write_text(rom: LocalRom, text: dict[str, dict[str, str]]):
@@ -398,8 +414,5 @@ def write_text(rom: LocalRom, text: dict[str, dict[str, str]]):
         for name, message in messages.items():
             array_index = TEXT_INDICES[group][name]
             encoded_message = Message(message).append(TERMINATOR_CHAR)
-            text_address = rom.append(encoded_message.to_bytes())
-            rom.write(
-                get_rom_address(data_table, 4 * array_index),
-                struct.pack("<I", text_address)
-            )
+            text_address = rom.append(encoded_message.to_bytes(), dedup=True)
+            rom.write_u32(get_rom_address(data_table, 4 * array_index), text_address)
@@ -1,13 +1,17 @@
 from __future__ import annotations
 
+from contextlib import contextmanager
+from contextvars import ContextVar
 from enum import IntEnum
+import functools
 import itertools
 import struct
-from typing import NamedTuple, cast
+from typing import Callable, NamedTuple, cast
 
-from . import iterators, lz10, rle
+from . import codecs, compression, iterators, rle
 from .constants import Area
 from .local_rom import ROM_START, LocalRom, get_rom_address
+from .symbols import get_symbol_end, rom_symbols
 
 
 class Clipdata(IntEnum):
@@ -52,6 +56,13 @@ class BackgroundProperties(IntEnum):
     STARTS_FROM_BOTTOM = LZ77_COMPRESSED | 6
 
 
+codecs.register(BackgroundProperties.RLE_COMPRESSED, codecs.RLE)
+codecs.register(BackgroundProperties.LZ77_COMPRESSED, codecs.LZ10)
+
+# Most tilemaps only have a few tiles changed, so codecs that can do that without decompressing them are preferred
+TILEMAP_CAPABILITIES = codecs.Capability.PARTIAL_DECODE | codecs.Capability.IN_PLACE_EDIT
+
+
 class BackgroundInfo(NamedTuple):
     rom: LocalRom
     properties: BackgroundProperties
@@ -149,17 +160,21 @@ class BackgroundTilemap:
     width: int
     height: int
     compression: BackgroundProperties
+    codec: codecs.Codec
     bg_size: int | None
-    decompressed: bytearray
+    run_index: rle.RunIndex | None
+    _decompressed: bytearray | None
     compressed_size: int
 
     def __init__(self, compressed_data: memoryview, compression: BackgroundProperties, vanilla_size: int = 0):
+        self.run_index = None
+        self._decompressed = None
+        self.codec = codecs.get_codec(compression, preferred=TILEMAP_CAPABILITIES)
         if compression & BackgroundProperties.RLE_COMPRESSED:
             self.width = compressed_data[0]
             self.height = compressed_data[1]
             self.compression = BackgroundProperties.RLE_COMPRESSED
-            self.decompressed = rle.decompress(compressed_data[2:])
-        elif compression & BackgroundProperties.LZ77_COMPRESSED:
+        else:
             self.bg_size = compressed_data[0]
             self.width = self.height = 256 // 8
             if self.bg_size & 1:
@@ -167,46 +182,199 @@ class BackgroundTilemap:
             if self.bg_size & 2:
                 self.height *= 2
             self.compression = BackgroundProperties.LZ77_COMPRESSED
-            self.decompressed = lz10.decompress(compressed_data[4:])
+        data = compressed_data[len(self._compressed_header()):]
+        if self.codec.capabilities & TILEMAP_CAPABILITIES == TILEMAP_CAPABILITIES:
+            # Decompressed only when needed
+            self.run_index = self.codec.open_index(data)
         else:
-            raise ValueError(f"Invalid background properties: {compression:02x}")
+            self._decompressed = self.codec.decompress(data)
         self.compressed_size = vanilla_size
 
     @classmethod
     def from_info(cls, info: BackgroundInfo, max_compressed_size: int = 0):
+        deferred = _deferred_writes.get()
+        assert deferred is None or (info.rom, info.rom_address()) not in deferred.addresses, \
+            f"Tilemap at {info.rom_address():x} was read before its deferred write"
         return cls(info.compressed_data(), info.properties, max_compressed_size)
 
+    @property
+    def decompressed(self) -> bytearray:
+        """The decompressed tilemap. Change tiles with set() instead of through this, so RLE tilemaps see the change."""
+        if self._decompressed is None:
+            self._decompressed = self.run_index.decompress()
+        return self._decompressed
+
+    def tile_at(self, x: int, y: int) -> int:
+        index = (y * self.width + x) * 2
+        if self._decompressed is None:
+            return self.run_index[index] | self.run_index[index + 1] << 8
+        return int.from_bytes(self._decompressed[index:index + 2], "little")
+
     def set(self, x: int, y: int, tile: int, original_tile: int | None = None):
         index = (y * self.width + x) * 2
         if original_tile is not None:
-            found_tile = int.from_bytes(self.decompressed[index:index + 2], "little")
+            found_tile = self.tile_at(x, y)
             if found_tile != original_tile:
                 raise ValueError(f"Unexpected tile at ({x}, {y}) (expected {original_tile:04x}, found {found_tile:04x})")
-        self.decompressed[index:index + 2] = tile.to_bytes(2, "little")
+        if self.run_index is not None:
+            self.run_index[index] = tile & 0xFF
+            self.run_index[index + 1] = tile >> 8
+        if self._decompressed is not None:
+            self._decompressed[index:index + 2] = tile.to_bytes(2, "little")
 
-    def to_compressed_data(self) -> bytes:
+    def _compressed_header(self) -> bytes:
         if self.compression == BackgroundProperties.RLE_COMPRESSED:
-            compressed_data = bytes((self.width, self.height)) + rle.compress(self.decompressed)
+            return bytes((self.width, self.height))
         if self.compression == BackgroundProperties.LZ77_COMPRESSED:
-            compressed_data = self.bg_size.to_bytes(4, "little") + lz10.compress(self.decompressed)
-        return compressed_data
+            return self.bg_size.to_bytes(4, "little")
+
+    def _compressed_budget(self, buffer_size: int) -> int:
+        """
+        Space available for the compressed tilemap after its header. A tilemap with no buffer is moved to free space,
+        so it gets no space, which makes it compressed as small as possible.
+        """
+        return max(buffer_size - len(self._compressed_header()), 0)
+
+    def to_compressed_data(self, buffer_size: int | None = None) -> bytes:
+        """
+        Compress the tilemap, trying harder to compress it if it would not fit in a buffer of `buffer_size` bytes, by
+        default its original buffer.
+        """
+        if buffer_size is None:
+            buffer_size = self.compressed_size
+        return self._compressed_header() + self.codec.compress_to_fit(self.decompressed,
+                                                                      self._compressed_budget(buffer_size))
+
+    def to_compressed_size(self) -> int:
+        """The smallest size the tilemap can be compressed to, found without compressing it."""
+        return len(self._compressed_header()) + self.codec.compressed_size(self.decompressed)
+
+    def fits(self, buffer_size: int | None = None) -> bool:
+        """
+        Whether the compressed tilemap fits in a buffer of `buffer_size` bytes, by default its original buffer. It is
+        compressed the same way as writing it would, through the compression cache, so writing it afterward doesn't
+        compress it again.
+        """
+        if buffer_size is None:
+            buffer_size = self.compressed_size
+        return bool(buffer_size) and len(self.to_compressed_data(buffer_size)) <= buffer_size
+
+    def _compressed_changes(self, buffer_size: int) -> tuple[int, bytes] | None:
+        """
+        Where to write over the original compressed tilemap and what to write there to change it to this one, or None
+        if it can't be changed in place and must be compressed again.
+        """
+        if self.run_index is None or not buffer_size:
+            return None
+        offset, changes, size = self.run_index.changes()
+        if len(self._compressed_header()) + size > buffer_size:
+            return None
+        return len(self._compressed_header()) + offset, changes
+
+    def _write_compressed(self, write: Callable[[bytes], None], write_changes: Callable[[int, bytes], None],
+                          rom: LocalRom, address: int, buffer_size: int):
+        # Changes are written right away even when writes are deferred, since they are never moved to new space
+        changes = self._compressed_changes(buffer_size)
+        if changes is not None:
+            write_changes(*changes)
+            return
+        deferred = _deferred_writes.get()
+        if deferred is not None:
+            deferred.writes.append((self.codec, self._compressed_header(), bytes(self.decompressed),
+                                    self._compressed_budget(buffer_size), write))
+            deferred.addresses.add((rom, address))
+        else:
+            write(self.to_compressed_data(buffer_size))
 
     def write_in_place(self, rom: LocalRom, address: int):
-        data = self.to_compressed_data()
+        self._write_compressed(functools.partial(self._write_data_in_place, rom, address),
+                               functools.partial(self._write_changes, rom, address),
+                               rom, address, self.compressed_size)
+
+    def _write_data_in_place(self, rom: LocalRom, address: int, data: bytes):
         assert len(data) <= self.compressed_size, f"Compressed data of size {len(data)} overflows original buffer of size {self.compressed_size}"
         rom.write(address, data)
 
     def write(self, rom: LocalRom, ptr_address: int, data_address: int):
-        data = self.to_compressed_data()
-        if len(data) > self.compressed_size:
-            rom.write(ptr_address, rom.append(data).to_bytes(4, "little"))
-        else:
+        # The tilemap may have been moved to allocated space already, which can be smaller than the original buffer
+        buffer_size = rom.allocation_size(data_address) or self.compressed_size
+        self._write_compressed(functools.partial(self._write_data, rom, ptr_address, data_address, buffer_size),
+                               functools.partial(self._write_changes, rom, data_address),
+                               rom, data_address, buffer_size)
+
+    def _write_data(self, rom: LocalRom, ptr_address: int, data_address: int, buffer_size: int, data: bytes):
+        # The data was compressed as hard as needed to fit the buffer, so whether it fits is the same as fits() says,
+        # found without compressing or parsing the tilemap again
+        if len(data) <= buffer_size:
             rom.write(data_address, data)
+            return
+        # The old buffer can be reused, unless another room shares it
+        if buffer_size and tilemap_pointers_to(rom, data_address) == [ptr_address]:
+            rom.release(data_address, buffer_size)
+        rom.write_u32(ptr_address, rom.append(data))
+
+    def _write_changes(self, rom: LocalRom, address: int, offset: int, data: bytes):
+        rom.write(address + offset, data)
+        if compression.verify:
+            compression.verify_rle(self.decompressed, rom.view(address + len(self._compressed_header())))
 
     def to_halfword_matrix(self) -> list[list[int]]:
         return tuple(iterators.batched(itertools.chain.from_iterable(struct.iter_unpack("<H", self.decompressed)), self.width))
 
 
+# Tables whose entries can point to room tilemaps: tilesets and the room entries of every area, including test areas
+TILEMAP_POINTER_TABLES = ("sTilesetEntries", *(symbol for symbol in rom_symbols if symbol.endswith("RoomEntries")))
+
+
+def tilemap_pointers_to(rom: LocalRom, address: int) -> list[int]:
+    """Addresses of the pointers to the tilemap at `address` in the tables that can point to tilemaps."""
+    return [
+        pointer
+        for symbol in TILEMAP_POINTER_TABLES
+        for pointer in rom.pointers_to(address, get_rom_address(symbol), get_rom_address(get_symbol_end(symbol)))
+    ]
+
+
+class DeferredWrites(NamedTuple):
+    """Tilemap writes waiting for deferred_tilemap_writes() to exit."""
+    # Codec, header, decompressed data, space for compressed data, write function
+    writes: list[tuple[codecs.Codec, bytes, bytes, int | None, Callable[[bytes], None]]]
+    # ROM and address of each tilemap being written, which can't be read until it is
+    addresses: set[tuple[LocalRom, int]]
+
+
+# Local to each context, so that seeds patched at the same time in different threads don't share writes
+_deferred_writes: ContextVar[DeferredWrites | None] = ContextVar("deferred_writes", default=None)
+
+
+@contextmanager
+def deferred_tilemap_writes():
+    """
+    Delay writing tilemaps until the end of the context, so that they can all be compressed at once, in parallel if
+    enabled. Writes happen in the same order as without deferring them. Tilemaps read within the context must not have
+    been written within it.
+    """
+    if _deferred_writes.get() is not None:
+        yield
+        return
+
+    deferred = DeferredWrites([], set())
+    token = _deferred_writes.set(deferred)
+    try:
+        yield
+    finally:
+        _deferred_writes.reset(token)
+
+    inputs: dict[codecs.Codec, tuple[list[bytes], list[int | None]]] = {}
+    for codec, _, data, budget, _ in deferred.writes:
+        codec_inputs = inputs.setdefault(codec, ([], []))
+        codec_inputs[0].append(data)
+        codec_inputs[1].append(budget)
+    compressed = {codec: iter(codec.compress_many_to_fit(*codec_inputs)) for codec, codec_inputs in inputs.items()}
+    for codec, header, _, _, write in deferred.writes:
+        write(header + next(compressed[codec]))
+
+
 # Tuples are: Clipdata offset, BG1 offset
 item_clipdata_and_gfx: dict[Area, dict[int, list[tuple[int | None, int | None]]]] = {
     Area.BRINSTAR: {
@@ -305,7 +473,7 @@ item_clipdata_and_gfx: dict[Area, dict[int, list[tuple[int | None, int | None]]]
 
 def get_backgrounds(rom: LocalRom, area: Area, room: int) -> RoomInfo:
     room_entry_pointer_array_addr = get_rom_address("sAreaRoomEntryPointers")
-    room_entry_array_addr = rom.read((room_entry_pointer_array_addr + 4 * area) & (ROM_START - 1), "<I")[0]
+    room_entry_array_addr = rom.read_u32((room_entry_pointer_array_addr + 4 * area) & (ROM_START - 1))
     room_entry_addr = (room_entry_array_addr + 60 * room) & (ROM_START - 1)
     return RoomInfo.from_pointer(rom, room_entry_addr)
 
@@ -313,17 +481,30 @@ def get_backgrounds(rom: LocalRom, area: Area, room: int) -> RoomInfo:
 def write_item_clipdata_and_gfx(rom: LocalRom):
     for area, rooms in item_clipdata_and_gfx.items():
         for room, items in rooms.items():
+            backgrounds = get_backgrounds(rom, area, room)
+            clip = None
             for i, (clip_offset, bg1_offset) in enumerate(items):
-                backgrounds = get_backgrounds(rom, area, room)
                 if clip_offset is not None:
-                    clipdata = rom.read(backgrounds.clipdata.rom_address() + clip_offset, "<B")[0]
+                    if clip is None:
+                        clip = BackgroundTilemap.from_info(backgrounds.clipdata)
+                        # Changing tanks doesn't change the size of the clipdata, so it is written over in place
+                        clip.compressed_size = 2 + clip.run_index.original_size
+                    # The offsets are into the original compressed data, so find the tiles they are the values of.
+                    # Each must be a single tile, not a run of them
+                    tile_offset = clip.run_index.decompressed_offset(clip_offset - 2, unique_only=True)
+                    assert tile_offset % 2 == 0, f"Offset 0x{clip_offset:x} in {area.name.title()} {room} clipdata is not a tile"
+                    y, x = divmod(tile_offset // 2, clip.width)
+                    clipdata = clip.tile_at(x, y)
                     behavior = (clipdata - Clipdata.ENERGY_TANK) & 0xF0
-                    assert behavior in range(0x00, 0x30, 0x10), f"Expected tank clipdata in {area.name.title()} {room} at offset 0x{clip_offset:x}, found 0x{clipdata:02x}"
-                    rom.write(backgrounds.clipdata.rom_address() + clip_offset, struct.pack("<B", Clipdata.ENERGY_TANK + i + behavior))
+                    assert behavior in range(0x00, 0x30, 0x10), f"Expected tank clipdata in {area.name.title()} {room} at ({x}, {y}), found 0x{clipdata:02x}"
+                    clip.set(x, y, clipdata & 0xFF00 | (Clipdata.ENERGY_TANK + i + behavior))
                 if bg1_offset is not None:
-                    rom.write(backgrounds.bg1.rom_address() + bg1_offset, struct.pack("<B", 0x49 - i))
+                    rom.write_u8(backgrounds.bg1.rom_address() + bg1_offset, 0x49 - i)
+            if clip is not None:
+                clip.write_in_place(rom, backgrounds.clipdata.rom_address())
 
 
+@deferred_tilemap_writes()
 def patch_chozodia_spotlight(rom: LocalRom):
     chozodia_before_map = get_backgrounds(rom, Area.CHOZODIA, 10).bg0
     chozodia_before_map_bg0 = BackgroundTilemap.from_info(chozodia_before_map, 320)
@@ -346,6 +527,7 @@ def _door_tiles(start: int) -> range:
     return range(start, start + 0x40, 0x10)
 
 
+@deferred_tilemap_writes()
 def fix_crateria_door_locks(rom: LocalRom):
     # (Door function data patched in basepatch)
     gray_door_left_tiles = _door_tiles(6)
@@ -0,0 +1,117 @@
+"""
+Compression formats used by room tilemaps, looked up by the background property bits that select them.
+
+A format can have more than one implementation. Each is registered with the things it can do besides compressing and
+decompressing, and an estimate of how long it takes. Tilemaps use the fastest implementation that can do what they
+need, so a faster one can be added, and compared with the others using benchmark(), without changing the tilemaps.
+"""
+
+from __future__ import annotations
+
+from enum import IntFlag
+import functools
+import time
+from typing import Callable, NamedTuple, Sequence
+
+from . import compression, lz10, rle
+from .lz10 import ByteString
+
+
+class Capability(IntFlag):
+    NONE = 0
+    STREAMING = 1  # Can compress data that is fed to an encoder in pieces
+    PARTIAL_DECODE = 2  # Can read part of the data without decompressing all of it, through an index
+    IN_PLACE_EDIT = 4  # Can edit the data through an index, and give just the compressed bytes that changed
+
+
+class Codec(NamedTuple):
+    name: str
+    capabilities: Capability
+    # Relative time to compress and decompress data; lower is faster
+    cost: float
+    decompress: Callable[[ByteString], bytearray]
+    # Compresses without caching, for comparing implementations
+    compress: Callable[[ByteString], ByteString]
+    # The smallest size compress_to_fit() can compress data to
+    compressed_size: Callable[[ByteString], int]
+    compress_to_fit: Callable[[ByteString, int | None], bytes]
+    compress_many_to_fit: Callable[[Sequence[ByteString], Sequence[int | None]], list[bytes]]
+    # Required for STREAMING
+    encoder: Callable[[], lz10.LZ10Encoder] | None = None
+    # Required for PARTIAL_DECODE and IN_PLACE_EDIT
+    open_index: Callable[[ByteString], rle.RunIndex] | None = None
+
+
+RLE = Codec(
+    "rle",
+    Capability.PARTIAL_DECODE | Capability.IN_PLACE_EDIT,
+    1.0,
+    rle.decompress,
+    rle.compress,
+    rle.compressed_size,
+    compression.compress_rle_to_fit,
+    compression.compress_rle_many_to_fit,
+    open_index=rle.RunIndex,
+)
+
+LZ10 = Codec(
+    "lz10",
+    Capability.STREAMING,
+    1.0,
+    lz10.decompress,
+    lz10.compress,
+    functools.partial(lz10.compressed_size, level="optimal"),
+    compression.compress_lz10_to_fit,
+    compression.compress_lz10_many_to_fit,
+    encoder=lz10.LZ10Encoder,
+)
+
+
+# Implementations of each format, by the property bit that selects it, in the order the bits are checked
+_registry: dict[int, list[Codec]] = {}
+
+
+def register(property_bit: int, codec: Codec):
+    """Add an implementation of the format selected by `property_bit`, replacing any with the same name."""
+    codecs = _registry.setdefault(property_bit, [])
+    codecs[:] = [c for c in codecs if c.name != codec.name]
+    codecs.append(codec)
+
+
+def get_codecs(properties: int) -> list[Codec]:
+    """All implementations of the format used by background `properties`."""
+    for property_bit, codecs in _registry.items():
+        if properties & property_bit:
+            return codecs
+    raise ValueError(f"Invalid background properties: {properties:02x}")
+
+
+def get_codec(properties: int, required: Capability = Capability.NONE,
+              preferred: Capability = Capability.NONE) -> Codec:
+    """
+    The fastest implementation of the format used by background `properties` that has every `required` capability.
+    Implementations that also have every `preferred` capability are picked over faster ones that don't.
+    """
+    capable = [codec for codec in get_codecs(properties) if codec.capabilities & required == required]
+    if not capable:
+        raise ValueError(f"No codec for background properties {properties:02x} with capabilities {required!r}")
+    return min(capable, key=lambda codec: (codec.capabilities & preferred != preferred, codec.cost))
+
+
+def benchmark(properties: int, data: ByteString, repeat: int = 3) -> dict[str, float]:
+    """
+    Time compressing and decompressing `data` with each implementation of the format used by background `properties`,
+    taking the best of `repeat` tries. Each implementation's cost is set to its time, so that later lookups for this
+    format pick the one that was fastest with data like `data`.
+    """
+    codecs = get_codecs(properties)
+    times = {}
+    for i, codec in enumerate(codecs):
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            codec.decompress(codec.compress(data))
+            best = min(best, time.perf_counter() - start)
+        times[codec.name] = best
+        codecs[i] = codec._replace(cost=best)
+    return times
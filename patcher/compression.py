@@ -0,0 +1,361 @@
+"""
+Entry points to the LZ10 and RLE encoders that reuse the results of earlier compression.
+
+Most data that gets recompressed while patching is the same for every seed, so results are cached by codec, encoder
+version, and the SHA-256 of the input data.
+
+If the MZM_VERIFY_COMPRESSION environment variable is set, everything compressed here is decompressed again and checked
+against the original data.
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import hashlib
+import logging
+import os
+from pathlib import Path
+import threading
+from typing import Callable, Sequence
+
+from . import lz10, rle
+from .lz10 import ByteString, CompressionLevel
+
+
+CacheKey = tuple[str, int, str]
+
+# Used to check results read from the cache directory, by the codec part of cache keys
+_decompressors: dict[str, Callable[[ByteString], ByteString]] = {"lz10": lz10.decompress, "rle": rle.decompress}
+
+
+class CompressionCache:
+    """
+    Recently used results are kept in memory, up to `max_entries` of them. If `directory` is set, every result is also
+    stored there so that it can be reused by later patching runs. Results read from there are decompressed and checked
+    against the data they are cached for, and deleted if they don't match.
+    """
+
+    max_entries: int
+    directory: Path | None
+    entries: OrderedDict[CacheKey, bytes]
+    lock: threading.Lock
+
+    def __init__(self, max_entries: int = 128, directory: Path | None = None):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _path(self, key: CacheKey) -> Path:
+        codec, version, digest = key
+        return self.directory / f"{codec}-{version}" / digest[:2] / digest
+
+    def get(self, key: CacheKey) -> bytes | None:
+        with self.lock:
+            result = self.entries.get(key)
+            if result is not None:
+                self.entries.move_to_end(key)
+                return result
+
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        try:
+            result = path.read_bytes()
+        except OSError:
+            return None
+        if not self._is_valid(key, result):
+            logging.warning(f"Deleting invalid compression cache entry {path}")
+            path.unlink(missing_ok=True)
+            return None
+        self._remember(key, result)
+        return result
+
+    @staticmethod
+    def _is_valid(key: CacheKey, result: bytes) -> bool:
+        codec, _, digest = key
+        decompress = _decompressors.get(codec.split("-")[0])
+        if decompress is None:
+            return False
+        try:
+            return hashlib.sha256(decompress(result)).hexdigest() == digest
+        except ValueError:
+            return False
+
+    def put(self, key: CacheKey, result: bytes):
+        self._remember(key, result)
+
+        if self.directory is None:
+            return
+        path = self._path(key)
+        temp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path.write_bytes(result)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logging.debug(f"Could not write compression cache entry {path}: {e}")
+            temp_path.unlink(missing_ok=True)
+
+    def _remember(self, key: CacheKey, result: bytes):
+        with self.lock:
+            self.entries[key] = result
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    @staticmethod
+    def key(codec: str, version: int, *parts: ByteString) -> CacheKey:
+        """Key for the result of compressing the concatenation of `parts`."""
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(part)
+        return codec, version, digest.hexdigest()
+
+    def get_or_compress(self, codec: str, version: int, data: ByteString,
+                        compress: Callable[[ByteString], ByteString]) -> bytes:
+        key = self.key(codec, version, data)
+        result = self.get(key)
+        if result is None:
+            result = bytes(compress(data))
+            self.put(key, result)
+        return result
+
+    def get_or_compress_many(self, codec: str, version: int, inputs: Sequence[ByteString],
+                             compress: Callable[[ByteString], ByteString], workers: int | None = None) -> list[bytes]:
+        """
+        Like get_or_compress(), but for several inputs at once. Inputs that are not cached are compressed in a process
+        pool of `workers` processes, defaulting to `max_workers`.
+        """
+        keys = [self.key(codec, version, data) for data in inputs]
+        results = {key: self.get(key) for key in keys}
+        missing = {key: data for key, data in zip(keys, inputs) if results[key] is None}
+
+        if workers is None:
+            workers = max_workers
+        if workers > 1 and len(missing) > 1:
+            compressed = _get_executor(workers).map(compress, [bytes(data) for data in missing.values()])
+        else:
+            compressed = map(compress, missing.values())
+        for key, result in zip(missing.keys(), compressed):
+            results[key] = bytes(result)
+            self.put(key, results[key])
+
+        return [results[key] for key in keys]
+
+
+class VerificationError(AssertionError):
+    """Compressed data doesn't decompress to the data it was compressed from."""
+
+
+def first_difference(a: ByteString, b: ByteString) -> int:
+    """Find the first offset where two buffers differ, or the length of the shorter one if it is a prefix of the other."""
+    a = bytes(a)
+    b = bytes(b)
+    low = 0
+    high = min(len(a), len(b))
+    # Compare slices, which is much faster than comparing one byte at a time
+    while low < high:
+        middle = (low + high) // 2
+        if a[low:middle + 1] == b[low:middle + 1]:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def changed_ranges(original: ByteString, edited: ByteString, chunk_size: int = 64) -> list[tuple[int, int]]:
+    """The (start, end) ranges of bytes that differ between two buffers of the same length."""
+    if len(original) != len(edited):
+        raise ValueError(f"Edited data is {len(edited)} bytes long, but the original is {len(original)} bytes long")
+    original = bytes(original)
+    edited = bytes(edited)
+    ranges: list[tuple[int, int]] = []
+    # Skip unchanged chunks by comparing slices, and only compare the changed ones a byte at a time
+    for chunk_start in range(0, len(edited), chunk_size):
+        chunk_end = chunk_start + chunk_size
+        if original[chunk_start:chunk_end] == edited[chunk_start:chunk_end]:
+            continue
+        for i in range(chunk_start, min(chunk_end, len(edited))):
+            if original[i] == edited[i]:
+                continue
+            if ranges and ranges[-1][1] == i:
+                ranges[-1] = (ranges[-1][0], i + 1)
+            else:
+                ranges.append((i, i + 1))
+    return ranges
+
+
+def verify_lz10(data: ByteString, compressed: ByteString):
+    _verify("LZ10", data, lz10.decompress(compressed))
+
+
+def verify_rle(data: ByteString, compressed: ByteString):
+    _verify("RLE", data, rle.decompress(compressed))
+
+
+def _verify(codec: str, data: ByteString, decompressed: ByteString):
+    if decompressed != data:
+        raise VerificationError(
+            f"{codec} compressed data of length {len(data)} decompresses to data of length {len(decompressed)}, "
+            f"which differs at offset 0x{first_difference(data, decompressed):x}"
+        )
+
+
+# Whether to check everything compressed here by decompressing it
+verify = bool(os.environ.get("MZM_VERIFY_COMPRESSION"))
+
+cache = CompressionCache()
+
+# Number of processes used to compress several inputs at once. Starting the processes takes time, so by default, data
+# is compressed in this process.
+max_workers = 1
+
+_executor: ProcessPoolExecutor | None = None
+_executor_workers = 0
+
+
+def _get_executor(workers: int) -> ProcessPoolExecutor:
+    global _executor, _executor_workers
+    if _executor is None or _executor_workers != workers:
+        if _executor is not None:
+            _executor.shutdown()
+        _executor = ProcessPoolExecutor(workers)
+        _executor_workers = workers
+    return _executor
+
+
+def compress_lz10(data: ByteString, level: CompressionLevel = "greedy") -> bytes:
+    compressed = cache.get_or_compress(
+        f"lz10-{level}", lz10.ENCODER_VERSION, data, lambda d: lz10.compress(d, level=level)
+    )
+    if verify:
+        verify_lz10(data, compressed)
+    return compressed
+
+
+def compress_lz10_many(inputs: Sequence[ByteString], level: CompressionLevel = "greedy",
+                       workers: int | None = None) -> list[bytes]:
+    results = cache.get_or_compress_many(
+        f"lz10-{level}", lz10.ENCODER_VERSION, inputs, functools.partial(lz10.compress, level=level), workers
+    )
+    if verify:
+        for data, compressed in zip(inputs, results):
+            verify_lz10(data, compressed)
+    return results
+
+
+# LZ10 levels from fastest to smallest output
+LZ10_LEVELS: tuple[CompressionLevel, ...] = ("fast", "greedy", "optimal")
+
+
+def _fits(data: bytes, budget: int | None):
+    return budget is None or len(data) <= budget
+
+
+def _levels(budget: int | None) -> tuple[CompressionLevel, ...]:
+    """Levels to try in order. Nothing fits in 0 bytes, so a budget of 0 goes straight to the smallest output."""
+    return LZ10_LEVELS[-1:] if budget == 0 else LZ10_LEVELS
+
+
+def compress_lz10_to_fit(data: ByteString, budget: int | None) -> bytes:
+    """
+    Compress with the fastest LZ10 level whose output is at most `budget` bytes, or with the fastest level if `budget`
+    is None. If no level is small enough, returns the smallest output, so the caller can decide what to do with it.
+    """
+    for level in _levels(budget):
+        compressed = compress_lz10(data, level)
+        if _fits(compressed, budget):
+            break
+    return compressed
+
+
+def compress_lz10_many_to_fit(inputs: Sequence[ByteString], budgets: Sequence[int | None],
+                              workers: int | None = None) -> list[bytes]:
+    """Like compress_lz10_to_fit(), but for several inputs at once."""
+    results: list[bytes] = [b""] * len(inputs)
+    remaining = range(len(inputs))
+    for level in LZ10_LEVELS:
+        current = [i for i in remaining if level in _levels(budgets[i])]
+        if not current:
+            continue
+        compressed = compress_lz10_many([inputs[i] for i in current], level, workers)
+        for i, result in zip(current, compressed):
+            results[i] = result
+        current = set(current)
+        remaining = [i for i in remaining if i not in current or not _fits(results[i], budgets[i])]
+        if not remaining:
+            break
+    return results
+
+
+def compress_lz10_parts_to_fit(parts: Sequence[ByteString], budget: int | None) -> bytes:
+    """
+    Like compress_lz10_to_fit(), but for data made of several parts. The parts are streamed into the encoder instead of
+    being joined, except at the optimal level, which needs all of the data at once.
+    """
+    for level in _levels(budget):
+        key = cache.key(f"lz10-{level}", lz10.ENCODER_VERSION, *parts)
+        compressed = cache.get(key)
+        if compressed is None:
+            if level == "optimal":
+                compressed = bytes(lz10.compress(b"".join(parts), level=level))
+            else:
+                encoder = lz10.LZ10Encoder(level=level)
+                for part in parts:
+                    encoder.feed(part)
+                compressed = bytes(encoder.finish())
+            cache.put(key, compressed)
+        if verify:
+            verify_lz10(b"".join(parts), compressed)
+        if _fits(compressed, budget):
+            break
+    return compressed
+
+
+def recompress_lz10_to_fit(compressed: ByteString, data: ByteString, budget: int | None) -> bytes:
+    """
+    Compress edited data by reusing the compressed data it was decompressed from, which is much faster than compressing
+    it from scratch. The edits are found by comparing `data` with the original data. Falls back to
+    compress_lz10_to_fit() if the result is larger than `budget`.
+    """
+    edits = changed_ranges(lz10.decompress(compressed), data)
+    recompressed = bytes(lz10.recompress(compressed, data, edits))
+    if verify:
+        verify_lz10(data, recompressed)
+    if _fits(recompressed, budget):
+        return recompressed
+    return compress_lz10_to_fit(data, budget)
+
+
+def compress_rle(data: ByteString) -> bytes:
+    compressed = cache.get_or_compress("rle", rle.ENCODER_VERSION, data, rle.compress)
+    if verify:
+        verify_rle(data, compressed)
+    return compressed
+
+
+def compress_rle_many(inputs: Sequence[ByteString], workers: int | None = None) -> list[bytes]:
+    results = cache.get_or_compress_many("rle", rle.ENCODER_VERSION, inputs, rle.compress, workers)
+    if verify:
+        for data, compressed in zip(inputs, results):
+            verify_rle(data, compressed)
+    return results
+
+
+# RLE has a single encoder, which already picks the smaller of its two encodings, so there is nothing to escalate to.
+# These exist so that callers can treat both codecs the same way.
+
+def compress_rle_to_fit(data: ByteString, budget: int | None) -> bytes:
+    return compress_rle(data)
+
+
+def compress_rle_many_to_fit(inputs: Sequence[ByteString], budgets: Sequence[int | None],
+                             workers: int | None = None) -> list[bytes]:
+    return compress_rle_many(inputs, workers)
@@ -1,5 +1,4 @@
 from enum import Enum, IntEnum
-import struct
 from typing import NamedTuple
 
 from .constants import Area
@@ -115,11 +114,5 @@ def _apply_connection(
     elif destination_data.direction != source_data.direction.inverse():
         raise NotImplementedError(error_message + "connecting elevators with the same direction")
 
-    rom.write(
-        get_rom_address(f"s{source_area}Doors", 12 * source_data.door_index + 6),
-        struct.pack("<B", destination_data.door_index),
-    )
-    rom.write(
-        get_rom_address("sAreaConnections", 3 * source_data.area_connection_index + 2),
-        struct.pack("<B", destination_area),
-    )
+    rom.write_u8(get_rom_address(f"s{source_area}Doors", 12 * source_data.door_index + 6), destination_data.door_index)
+    rom.write_u8(get_rom_address("sAreaConnections", 3 * source_data.area_connection_index + 2), destination_area)
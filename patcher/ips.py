@@ -0,0 +1,69 @@
+"""
+IPS patches, which list bytes to write over a file and where to write them.
+
+Addresses are 24 bits, and each record writes at most 0xFFFF bytes. No record can start at 0x454F46, since the address
+would be read as the "EOF" marker that ends the patch.
+"""
+
+from typing import Iterable
+
+from .lz10 import ByteString
+
+
+HEADER = b"PATCH"
+FOOTER = b"EOF"
+MAX_ADDRESS = 0xFFFFFF
+MAX_RECORD_SIZE = 0xFFFF
+EOF_ADDRESS = int.from_bytes(FOOTER, "big")
+
+
+def create(data: ByteString, extents: Iterable[tuple[int, int]]) -> bytes:
+    """Make a patch that writes the ranges of addresses in `extents` with what `data` has there."""
+    data = memoryview(data)
+    patch = bytearray(HEADER)
+    for start, end in extents:
+        if start == EOF_ADDRESS:
+            start -= 1
+        while start < end:
+            size = min(end - start, MAX_RECORD_SIZE)
+            if start + size == EOF_ADDRESS and start + size < end:
+                size = size - 1 if size > 1 else 2
+            if start + size - 1 > MAX_ADDRESS:
+                raise ValueError(f"Address 0x{start + size - 1:x} is too large for an IPS patch")
+            patch += start.to_bytes(3, "big")
+            patch += size.to_bytes(2, "big")
+            patch += data[start:start + size]
+            start += size
+    patch += FOOTER
+    return bytes(patch)
+
+
+def apply(data: ByteString, patch: ByteString) -> bytearray:
+    """Apply a patch to a copy of `data`, including records that repeat one byte."""
+    result = bytearray(data)
+    patch = memoryview(patch)
+    if patch[:len(HEADER)] != HEADER:
+        raise ValueError("Not an IPS patch")
+    i = len(HEADER)
+    try:
+        while patch[i:i + 3] != FOOTER:
+            address = int.from_bytes(patch[i:i + 3], "big")
+            size = int.from_bytes(patch[i + 3:i + 5], "big")
+            i += 5
+            if address > len(result):
+                result.extend(bytes(address - len(result)))
+            if size == 0:
+                size = int.from_bytes(patch[i:i + 2], "big")
+                value = patch[i + 2:i + 3]
+                if len(value) == 0:
+                    raise IndexError
+                i += 3
+                result[address:address + size] = value.tobytes() * size
+            else:
+                if i + size > len(patch):
+                    raise IndexError
+                result[address:address + size] = patch[i:i + size]
+                i += size
+    except IndexError:
+        raise ValueError("IPS patch ended early") from None
+    return result
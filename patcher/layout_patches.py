@@ -1,7 +1,7 @@
 from typing import Callable, Iterable, Literal
 
 from .constants import Area
-from .backgrounds import BackgroundTilemap, Clipdata, SpriteData, get_backgrounds
+from .backgrounds import BackgroundTilemap, Clipdata, SpriteData, deferred_tilemap_writes, get_backgrounds
 from .local_rom import LocalRom, get_rom_address
 
 
@@ -216,5 +216,8 @@ def apply_layout_patches(rom: LocalRom, patches: Iterable[str] | Literal["all"])
     if patches == "all":
         patches = LAYOUT_PATCH_MAPPING.keys()
 
-    for patch in patches:
-        LAYOUT_PATCH_MAPPING[patch](rom)
+    # None of the layout patches edit the same room, so all of their tilemaps can be compressed together. Reading a
+    # tilemap that another patch is waiting to write fails an assertion instead of reading the old one
+    with deferred_tilemap_writes():
+        for patch in patches:
+            LAYOUT_PATCH_MAPPING[patch](rom)
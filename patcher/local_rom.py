@@ -1,13 +1,39 @@
+from __future__ import annotations
+
+from bisect import bisect_left, bisect_right
+import hashlib
+import mmap
+import os
+from os import PathLike
+from pathlib import Path
 import struct
-from typing import Any, overload
+from typing import Any, NamedTuple, overload
 
-from . import lz10
+from . import ips, lz10
 from .symbols import get_symbol
 
 
 ROM_START = 0x8000000
 
 
+# Compiled structs, by format, shared by every ROM
+_structs: dict[str, struct.Struct] = {}
+
+
+def get_struct(format: str | struct.Struct) -> struct.Struct:
+    if isinstance(format, struct.Struct):
+        return format
+    compiled = _structs.get(format)
+    if compiled is None:
+        compiled = _structs[format] = struct.Struct(format)
+    return compiled
+
+
+U8 = get_struct("<B")
+U16 = get_struct("<H")
+U32 = get_struct("<I")
+
+
 def get_rom_address(ptr: str | int, offset=0):
     if isinstance(ptr, str):
         address = get_symbol(ptr, offset)
@@ -18,13 +44,214 @@ def get_rom_address(ptr: str | int, offset=0):
     return address & ROM_START - 1
 
 
+class SpaceReport(NamedTuple):
+    total: int
+    used: int
+    free: int
+    largest_free_block: int
+
+    def __str__(self):
+        return (f"0x{self.used:x} of 0x{self.total:x} bytes used, 0x{self.free:x} free, "
+                f"largest free block 0x{self.largest_free_block:x} bytes")
+
+
+class FreeSpace:
+    """
+    Free blocks of ROM space. Each allocation goes in the smallest block it fits in once aligned, and released space
+    is merged with the free blocks next to it.
+    """
+
+    # Sorted, non-overlapping, and non-adjacent free blocks
+    starts: list[int]
+    ends: list[int]
+    # Sizes of the allocations that haven't been released, by address
+    allocations: dict[int, int]
+    total: int
+
+    def __init__(self, start: int, end: int):
+        self.starts = [start]
+        self.ends = [end]
+        self.allocations = {}
+        self.total = end - start
+
+    def alloc(self, size: int, alignment: int = 4) -> int | None:
+        """Allocate `size` bytes at a multiple of `alignment`, or return None if no free block is large enough."""
+        assert size >= 0
+        best = None
+        for i, (start, end) in enumerate(zip(self.starts, self.ends)):
+            address = -(-start // alignment) * alignment
+            if address + size <= end and (best is None or end - start < self.ends[best] - self.starts[best]):
+                best = i
+        if best is None:
+            return None
+
+        start, end = self.starts[best], self.ends[best]
+        address = -(-start // alignment) * alignment
+        # Keep what is left on either side of the allocation
+        remaining = [(s, e) for s, e in ((start, address), (address + size, end)) if s < e]
+        self.starts[best:best + 1] = [s for s, _ in remaining]
+        self.ends[best:best + 1] = [e for _, e in remaining]
+        self.allocations[address] = size
+        return address
+
+    def release(self, address: int, size: int):
+        """Return space to the free blocks. It can be space that was allocated, or space that was never free."""
+        if self.allocations.get(address) == size:
+            del self.allocations[address]
+        else:
+            self.total += size
+        end = address + size
+        first = bisect_left(self.ends, address)
+        last = bisect_right(self.starts, end)
+        assert all(self.ends[i] <= address or self.starts[i] >= end for i in range(first, last)), \
+            f"Released space 0x{address:07x}-0x{end:07x} is already free"
+        if first < last:
+            address = min(address, self.starts[first])
+            end = max(end, self.ends[last - 1])
+        self.starts[first:last] = [address]
+        self.ends[first:last] = [end]
+
+    def report(self) -> SpaceReport:
+        free = [end - start for start, end in zip(self.starts, self.ends)]
+        return SpaceReport(self.total, self.total - sum(free), sum(free), max(free, default=0))
+
+
+class RecordTable:
+    """
+    A table of fixed-size records in the ROM, edited in memory and written back all at once by write(). Rows start with
+    what the ROM has, and fill() sets the rows that haven't been set to a default record.
+    """
+
+    rom: LocalRom
+    struct: struct.Struct
+    address: int
+    buffer: bytearray
+    # Whether each row has been set
+    _set: bytearray
+
+    def __init__(self, rom: LocalRom, format: str | struct.Struct, address: int, count: int):
+        self.rom = rom
+        self.struct = get_struct(format)
+        self.address = address
+        self.buffer = bytearray(rom.read(address, self.struct.size * count))
+        if len(self.buffer) != self.struct.size * count:
+            raise ValueError(f"Table of {count} records at 0x{address:07x} doesn't fit in the ROM")
+        self._set = bytearray(count)
+
+    def __len__(self):
+        return len(self._set)
+
+    def _check_index(self, index: int):
+        if index not in range(len(self)):
+            raise IndexError(f"Record {index} out of range for table of {len(self)} records")
+
+    def __getitem__(self, index: int) -> tuple[Any, ...]:
+        self._check_index(index)
+        return self.struct.unpack_from(self.buffer, index * self.struct.size)
+
+    def __setitem__(self, index: int, values: tuple[Any, ...]):
+        self._check_index(index)
+        self.struct.pack_into(self.buffer, index * self.struct.size, *values)
+        self._set[index] = True
+
+    def is_full(self) -> bool:
+        """Whether every row has been set."""
+        return all(self._set)
+
+    def fill(self, *values):
+        """Set every row that hasn't been set to the same record."""
+        record = self.struct.pack(*values)
+        size = self.struct.size
+        for index, is_set in enumerate(self._set):
+            if not is_set:
+                self.buffer[index * size:(index + 1) * size] = record
+                self._set[index] = True
+
+    def write(self):
+        self.rom.write(self.address, self.buffer)
+
+
 class LocalRom:
-    data: bytearray
-    extra_space_address: int
+    """
+    A ROM being patched. Every write is recorded in a journal of the address ranges that were changed.
 
-    def __init__(self, data: bytes):
-        self.data = bytearray(data)
-        self.extra_space_address = get_rom_address("sRandoExtraData")
+    A LocalRom made by copy_on_write() maps its base image from a file instead of copying it. Pages of the file are
+    only copied into memory when they are written to, so any number of ROMs patched from the same file share the
+    parts none of them change, until one grows past the end of the file and is copied into memory. One made by
+    open_output() maps a temporary file next to the file it is being written to, so writes go straight to the file,
+    which is extended and mapped again if the ROM grows past its end.
+    """
+
+    data: bytearray | mmap.mmap
+    # Space from sRandoExtraData to the end of the ROM, and any space released since
+    free_space: FreeSpace
+    # Sorted, non-overlapping, and non-adjacent ranges of addresses that were written to
+    _journal_starts: list[int]
+    _journal_ends: list[int]
+    # Addresses of data appended with dedup set, by the SHA-256 of the data
+    _appended: dict[bytes, int]
+    # For a ROM made by open_output(), the file being written and where it is moved when the ROM is closed
+    _temp_path: Path | None
+    _output_path: Path | None
+
+    def __init__(self, data: bytes | bytearray | mmap.mmap):
+        if isinstance(data, mmap.mmap):
+            self.data = data
+        else:
+            self.data = bytearray(data)
+        self.free_space = FreeSpace(get_rom_address("sRandoExtraData"), len(self.data))
+        self._journal_starts = []
+        self._journal_ends = []
+        self._appended = {}
+        self._temp_path = None
+        self._output_path = None
+
+    @classmethod
+    def copy_on_write(cls, path: str | PathLike[str]) -> LocalRom:
+        """Patch the ROM in a file without copying it or changing the file."""
+        with open(path, "rb") as file:
+            return cls(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY))
+
+    @classmethod
+    def open_output(cls, path: str | PathLike[str], data: bytes) -> LocalRom:
+        """
+        Write `data` to a temporary file next to `path` and patch it there. The file is moved to `path` when the ROM
+        is closed, or deleted instead if the ROM is closed by an exception leaving its context.
+        """
+        path = Path(path)
+        temp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        try:
+            with open(temp_path, "w+b") as file:
+                file.write(data)
+                file.flush()
+                rom = cls(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_WRITE))
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+        rom._temp_path = temp_path
+        rom._output_path = path
+        return rom
+
+    def close(self, discard: bool = False):
+        """
+        Release the file mapped by copy_on_write() or open_output(). The file written by the latter is moved to the
+        path it was opened for, or deleted if `discard` is set. Views of the ROM must have been released first.
+        """
+        if isinstance(self.data, mmap.mmap) and not self.data.closed:
+            self.data.flush()
+            self.data.close()
+        if self._temp_path is not None:
+            if discard:
+                self._temp_path.unlink(missing_ok=True)
+            else:
+                os.replace(self._temp_path, self._output_path)
+            self._temp_path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(discard=exc_type is not None)
 
     @overload
     def read(self, address: int, length: int) -> bytes:
@@ -36,38 +263,161 @@ class LocalRom:
 
     def read(self, address: int, length_or_struct: int | str):
         if type(length_or_struct) is int:
-            length = length_or_struct
-        else:
-            length = struct.calcsize(length_or_struct)
-        data = self.data[address:address + length]
-        if type(length_or_struct) is int:
-            return data
-        else:
-            return struct.unpack(length_or_struct, data)
+            return self.data[address:address + length_or_struct]
+        return self.read_struct(length_or_struct, address)
+
+    def read_struct(self, format: str | struct.Struct, address: int) -> tuple[Any, ...]:
+        return get_struct(format).unpack_from(self.data, address)
+
+    def read_u8(self, address: int) -> int:
+        return U8.unpack_from(self.data, address)[0]
+
+    def read_u16(self, address: int) -> int:
+        return U16.unpack_from(self.data, address)[0]
+
+    def read_u32(self, address: int) -> int:
+        return U32.unpack_from(self.data, address)[0]
 
     def view(self, start_address: int) -> memoryview:
         return memoryview(self.data)[start_address:]
 
-    def decompress_lzss(self, address: int) -> bytes:
-        return bytes(lz10.decompress(self.view(address)))
+    def decompress_lzss(self, address: int, length: int | None = None) -> bytes:
+        if length is None:
+            return bytes(lz10.decompress(self.view(address)))
+        return bytes(lz10.decompress_prefix(self.view(address), length))
 
-    def alloc(self, size: int) -> int:
-        assert size >= 0
-        # Word-align all allocations
-        if self.extra_space_address % 4 != 0:
-            self.extra_space_address += 4 - self.extra_space_address % 4
-        address = self.extra_space_address
-        self.extra_space_address += size
+    def decompress_lzss_mutable(self, address: int) -> bytearray:
+        """Decompress data from the ROM into a new buffer that can be edited in place."""
+        return lz10.decompress(self.view(address))
+
+    def alloc(self, size: int, alignment: int = 4) -> int:
+        address = self.free_space.alloc(size, alignment)
+        if address is not None:
+            return address
+        # Make the ROM larger
+        end = len(self.data)
+        free_space = self.free_space
+        if free_space.ends and free_space.starts[-1] < free_space.ends[-1] == end:
+            # Extend the free block at the end of the ROM instead of starting after it
+            address = -(-free_space.starts[-1] // alignment) * alignment
+            self._grow(address + size)
+            free_space.release(end, address + size - end)
+            return free_space.alloc(size, alignment)
+        address = -(-end // alignment) * alignment
+        self._grow(address + size)
+        free_space.total += address + size - end
+        free_space.allocations[address] = size
         return address
 
+    def _grow(self, size: int):
+        """Make the ROM `size` bytes long, filling the new space with zeros. Views of the ROM must have been released."""
+        if not isinstance(self.data, mmap.mmap):
+            self.data.extend(bytes(size - len(self.data)))
+            return
+        if self._temp_path is None:
+            # The file mapped copy-on-write must not change, so the ROM is copied into memory
+            data = bytearray(self.data)
+            self.data.close()
+            self.data = data
+            self.data.extend(bytes(size - len(self.data)))
+            return
+        # Mappings can't be resized everywhere, so the file is extended and mapped again
+        self.data.flush()
+        self.data.close()
+        with open(self._temp_path, "r+b") as file:
+            file.truncate(size)
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_WRITE)
+
+    def release(self, address: int, size: int):
+        """Make space in the ROM free to be allocated again, such as a buffer whose data was moved elsewhere."""
+        self.free_space.release(address, size)
+
+    def allocation_size(self, address: int) -> int | None:
+        """The size of the space allocated at `address`, or None if it wasn't allocated or was released."""
+        return self.free_space.allocations.get(address)
+
+    def space_report(self) -> SpaceReport:
+        return self.free_space.report()
+
+    def pointers_to(self, address: int, start: int = 0, end: int | None = None) -> list[int]:
+        """Addresses of the words from `start` to `end` in the ROM that are pointers to `address`."""
+        if end is None:
+            end = len(self.data)
+        pointer = (address | ROM_START).to_bytes(4, "little")
+        found = []
+        i = self.data.find(pointer, start, end)
+        while i != -1:
+            if i % 4 == 0:
+                found.append(i)
+            i = self.data.find(pointer, i + 1, end)
+        return found
+
     def write(self, address: int, data: bytes):
         assert address <= len(self.data), f"Address 0x{address:07x} out of range for ROM length 0x{len(self.data):07x}"
+        if isinstance(self.data, mmap.mmap) and address + len(data) > len(self.data):
+            self._grow(address + len(data))
         self.data[address:address + len(data)] = data
+        self._record_write(address, address + len(data))
+
+    def table(self, format: str | struct.Struct, address: int, count: int) -> RecordTable:
+        """Edit the table of `count` records of the given format at `address`. Edits are saved by its write()."""
+        return RecordTable(self, format, address, count)
+
+    def write_struct(self, format: str | struct.Struct, address: int, *values):
+        """Pack values straight into the ROM, which must already be large enough to hold them."""
+        compiled = get_struct(format)
+        compiled.pack_into(self.data, address, *values)
+        self._record_write(address, address + compiled.size)
 
-    def append(self, data: bytes):
-        address = self.alloc(len(data))
-        self.write(address, data)
+    def write_u8(self, address: int, value: int):
+        self.write_struct(U8, address, value)
+
+    def write_u16(self, address: int, value: int):
+        self.write_struct(U16, address, value)
+
+    def write_u32(self, address: int, value: int):
+        self.write_struct(U32, address, value)
+
+    def _record_write(self, start: int, end: int):
+        if start == end:
+            return
+        starts, ends = self._journal_starts, self._journal_ends
+        # Merge with every range that overlaps or touches this one
+        first = bisect_left(ends, start)
+        last = bisect_right(starts, end)
+        if first < last:
+            start = min(start, starts[first])
+            end = max(end, ends[last - 1])
+        starts[first:last] = [start]
+        ends[first:last] = [end]
+
+    def written_extents(self) -> list[tuple[int, int]]:
+        """The ranges of addresses that were written to, as sorted (start, end) pairs, merging ones that touch."""
+        return list(zip(self._journal_starts, self._journal_ends))
+
+    def append(self, data: bytes, dedup: bool = False):
+        """
+        Write data to newly allocated space and return a pointer to it. If `dedup` is set and the same data was already
+        appended with `dedup` set, and is still there, returns a pointer to that instead, so the data must never be
+        changed in place.
+        """
+        if not dedup:
+            address = self.alloc(len(data))
+            self.write(address, data)
+            return address | ROM_START
+
+        key = hashlib.sha256(data).digest()
+        address = self._appended.get(key)
+        if (address is None or self.allocation_size(address) != len(data)
+                or self.data[address:address + len(data)] != data):
+            address = self.alloc(len(data))
+            self.write(address, data)
+            self._appended[key] = address
         return address | ROM_START
 
     def to_bytes(self):
         return bytes(self.data)
+
+    def to_ips(self) -> bytes:
+        """An IPS patch that makes the ROM this was created from into this ROM, made from the ranges written to."""
+        return ips.create(self.data, self.written_extents())
@@ -18,12 +18,22 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from collections import defaultdict
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, deque
 from operator import itemgetter
 import struct
-from typing import Union
+from typing import Iterable, Literal, Union
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 ByteString = Union[bytes, bytearray, memoryview]
+CompressionLevel = Literal["fast", "greedy", "optimal"]
+
+# Increment whenever a change to the encoder changes its output
+ENCODER_VERSION = 1
 
 
 """
@@ -47,14 +57,60 @@ def decompress(data: ByteString):
     return decompress_raw(data, decompressed_size)
 
 
-def compress(data: bytearray):
+def decompress_prefix(data: ByteString, stop_at: int):
+    """Decompress only the first `stop_at` bytes of LZSS-compressed bytes, ignoring the rest of the compressed data.
+    Returns a bytearray, which is shorter than `stop_at` if the decompressed data is."""
+    header = data[:4]
+    if header[0] != 0x10:
+        raise DecompressionError("not as lzss-compressed file")
+
+    decompressed_size = int.from_bytes(header[1:], "little")
+
+    data = data[4:]
+    return decompress_raw_lzss10(data, decompressed_size, stop_at=stop_at)
+
+
+def decompress_into(src: ByteString, dst: bytearray | memoryview) -> int:
+    """Decompress LZSS-compressed bytes into the start of `dst`, which must be at least as long as the decompressed
+    data. Returns the size of the decompressed data."""
+    header = src[:4]
+    if header[0] != 0x10:
+        raise DecompressionError("not as lzss-compressed file")
+
+    decompressed_size = int.from_bytes(header[1:], "little")
+    if len(dst) < decompressed_size:
+        raise ValueError(f"Buffer of size {len(dst)} is too small for {decompressed_size} bytes of decompressed data")
+
+    _decompress_raw_lzss10_into(memoryview(src)[4:], dst, decompressed_size, False, decompressed_size)
+    return decompressed_size
+
+
+def compress(data: ByteString, windowclass=None, level: CompressionLevel = "greedy"):
+    """Compress bytes with LZSS. Returns a bytearray containing the header, compressed data, and padding.
+
+    `windowclass` selects the match finder. By default, this is `HashChainWindow`, which produces the same output as
+    the reference `SlidingWindow`.
+
+    `level` selects how the data is split into tokens. "greedy" always takes the longest match available, while
+    "optimal" chooses the sequence of tokens that gives the smallest possible output, at the cost of searching for a
+    match at every position. "fast" is greedy, but by default only searches the nearest few matches."""
+    tokenize, windowclass = _get_tokenizer(level, windowclass)
+
     byteOut = bytearray()
     # header
     byteOut.extend(struct.pack("<L", (len(data) << 8) + 0x10))
 
     # body
-    length = 0
-    for tokens in chunkit(_compress(data), 8):
+    _write_tokens(tokenize(data, windowclass), byteOut)
+
+    # padding
+    _write_padding(byteOut)
+    return byteOut
+
+
+def _write_tokens(tokens, byteOut: bytearray):
+    """Write a stream of tokens from `_compress` to the end of `byteOut`."""
+    for tokens in chunkit(tokens, 8):
         flags = [type(t) == tuple for t in tokens]
         byteOut.extend(struct.pack(">B", packflags(flags)))
 
@@ -69,16 +125,338 @@ def compress(data: bytearray):
             else:
                 byteOut.extend(struct.pack(">B", t))
 
-        length += 1
-        length += sum(2 if f else 1 for f in flags)
 
-    # padding
-    padding = 4 - (length % 4 or 4)
+def _write_padding(byteOut: bytearray):
+    """Pad compressed data, starting with its header, to a multiple of 4 bytes."""
+    padding = 4 - (len(byteOut) % 4 or 4)
     if padding:
         byteOut.extend(b'\xff' * padding)
+
+
+class LZ10Encoder:
+    """Compresses data with LZSS as it is fed in.
+
+    Output is written to the end of `out` as each block of 8 tokens is completed; the header is written first with a
+    size of 0 and filled in by finish(). The result is identical to compress() at the same level. "optimal" needs all
+    of the data to choose its tokens, so only "fast" and "greedy" can be streamed, and the default match finders are
+    the pure Python ones, since the NumPy ones index all of the data up front."""
+
+    data: bytearray
+    out: bytearray
+
+    def __init__(self, out: bytearray | None = None, level: CompressionLevel = "greedy", windowclass=None):
+        if level == "fast":
+            windowclass = windowclass or FastHashChainWindow
+        elif level == "greedy":
+            windowclass = windowclass or HashChainWindow
+        else:
+            raise ValueError(f"Compression level can't be streamed: {level}")
+
+        # Input is kept for the match finder to look back into
+        self.data = bytearray()
+        self.window = windowclass(self.data)
+        self.out = bytearray() if out is None else out
+        self.header_offset = len(self.out)
+        self.out.extend(bytes(4))
+        self.block = bytearray()
+        self.flags = 0
+        self.token_count = 0
+        self.finished = False
+
+    def feed(self, chunk: ByteString):
+        """Add data to the end of the input and write every block that no longer depends on what comes next."""
+        if self.finished:
+            raise ValueError("Encoder is already finished")
+        self.data.extend(chunk)
+        # The match finder can only index a position once the bytes after it are known, and a match can extend up
+        # to `match_max` bytes past where it starts.
+        self._encode(len(self.data) - self.window.match_max - self.window.match_min)
+
+    def finish(self) -> bytearray:
+        """Write the rest of the compressed data, the padding, and the header's size. Returns `out`."""
+        if self.finished:
+            raise ValueError("Encoder is already finished")
+        self.finished = True
+        self._encode(len(self.data))
+
+        out = self.out
+        remaining = self.token_count % 8
+        if remaining:
+            out.append(self.flags << (8 - remaining))
+            out.extend(self.block)
+
+        # padding
+        length = len(out) - self.header_offset - 4
+        padding = 4 - (length % 4 or 4)
+        if padding:
+            out.extend(b'\xff' * padding)
+
+        out[self.header_offset:self.header_offset + 4] = struct.pack("<L", (len(self.data) << 8) + 0x10)
+        return out
+
+    def _encode(self, end: int):
+        """Write tokens for the input up to `end`."""
+        data = self.data
+        window = self.window
+        block = self.block
+        flags = self.flags
+        token_count = self.token_count
+        while window.index < end:
+            match = window.search()
+            if match:
+                count, disp = match
+                block.extend((((count - 3) << 12) | ((-disp) - 1)).to_bytes(2, "big"))
+                flags = flags << 1 | 1
+                window.advance(count)
+            else:
+                block.append(data[window.index])
+                flags <<= 1
+                window.next()
+
+            token_count += 1
+            if token_count % 8 == 0:
+                self.out.append(flags)
+                self.out.extend(block)
+                block.clear()
+                flags = 0
+        self.flags = flags
+        self.token_count = token_count
+
+
+def recompress(compressed: ByteString, data: ByteString, edits: Iterable[tuple[int, int]]) -> bytearray:
+    """Compress `data`, which is the data decompressed from `compressed` with the ranges of bytes in `edits` changed.
+
+    Each edit is a (start, end) pair. Compressed data is copied from `compressed` up to the first block of tokens that
+    contains an edit, and from the first block after the edits that can't copy from them. In between, tokens from
+    `compressed` are kept wherever neither the bytes they produce nor the bytes they copy from were edited. Everywhere
+    else, data is parsed greedily until the parse lands on the start of a token that can be kept again. The time this
+    takes depends mostly on the size of the edits, but the result may be a little larger than compressing from scratch.
+    """
+    header = compressed[:4]
+    if header[0] != 0x10:
+        raise DecompressionError("not as lzss-compressed file")
+    decompressed_size = int.from_bytes(header[1:], "little")
+    if len(data) != decompressed_size:
+        raise ValueError(f"Edited data is {len(data)} bytes long, but the original is {decompressed_size} bytes long")
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    src = memoryview(compressed)[4:]
+
+    edit_starts: list[int] = []
+    edit_ends: list[int] = []
+    for start, end in sorted(edits):
+        if start >= end:
+            continue
+        if edit_ends and start <= edit_ends[-1]:
+            edit_ends[-1] = max(edit_ends[-1], end)
+        else:
+            edit_starts.append(start)
+            edit_ends.append(end)
+
+    block_offsets, block_positions, body_end = _scan_blocks(src, decompressed_size)
+
+    byteOut = bytearray(header)
+    if not edit_starts:
+        byteOut.extend(src[:body_end])
+        _write_padding(byteOut)
+        return byteOut
+
+    first_block = bisect_right(block_positions, edit_starts[0]) - 1
+    # Nothing in these blocks can copy from an edit
+    copy_block = bisect_left(block_positions, edit_ends[-1] + SlidingWindow.size)
+    start = block_positions[first_block]
+    if copy_block < len(block_positions):
+        end = block_positions[copy_block]
+        tokens = _reparse(src[block_offsets[first_block]:block_offsets[copy_block]], data, start, end,
+                          edit_starts, edit_ends)
+        if not _add_tokens(tokens, data, start, -len(tokens) % 8):
+            copy_block = len(block_positions)
+    if copy_block == len(block_positions):
+        tokens = _reparse(src[block_offsets[first_block]:body_end], data, start, decompressed_size,
+                          edit_starts, edit_ends)
+
+    byteOut.extend(src[:block_offsets[first_block]])
+    _write_tokens(tokens, byteOut)
+    if copy_block < len(block_positions):
+        byteOut.extend(src[block_offsets[copy_block]:body_end])
+    _write_padding(byteOut)
     return byteOut
 
 
+def _scan_blocks(indata, decompressed_size: int) -> tuple[list[int], list[int], int]:
+    """Find where each block of 8 tokens in LZSS-compressed data starts. Returns the offset of each block's flags, the
+    position in the decompressed data where each block starts, and the end of the compressed data."""
+    flag_runs = FLAG_RUNS
+    offsets = []
+    positions = []
+    pos = 0
+    i = 0
+    try:
+        while pos < decompressed_size:
+            offsets.append(i)
+            positions.append(pos)
+            runs = flag_runs[indata[i]]
+            i += 1
+            for run in runs:
+                if run:
+                    if pos + run > decompressed_size:
+                        run = decompressed_size - pos
+                    i += run
+                    pos += run
+                else:
+                    pos += (indata[i] >> 4) + 3
+                    i += 2
+                if pos >= decompressed_size:
+                    break
+    except IndexError:
+        raise DecompressionError("compressed data ended before the expected size") from None
+    if i > len(indata):
+        raise DecompressionError("compressed data ended before the expected size")
+    if pos != decompressed_size:
+        raise DecompressionError("decompressed size does not match the expected size")
+    return offsets, positions, i
+
+
+def _read_tokens(indata, start: int, end: int) -> tuple[list[int], list]:
+    """Read the tokens of LZSS-compressed data from position `start` to `end` in the same form as `_compress`, along
+    with the position in the decompressed data where each starts. `indata` must start with a block's flags."""
+    positions = []
+    tokens = []
+    pos = start
+    i = 0
+    while pos < end:
+        flags = indata[i]
+        i += 1
+        for flag in bits(flags):
+            if pos >= end:
+                break
+            positions.append(pos)
+            if flag:
+                sh = indata[i] << 8 | indata[i + 1]
+                i += 2
+                count = (sh >> 0xc) + 3
+                disp = (sh & 0xfff) + 1
+                if disp > pos:
+                    raise DecompressionError("back-reference before the start of the data")
+                tokens.append((count, -disp))
+                pos += count
+            else:
+                tokens.append(indata[i])
+                i += 1
+                pos += 1
+    return positions, tokens
+
+
+def _reparse(indata, data: bytes | bytearray, start: int, end: int, edit_starts: list[int], edit_ends: list[int]):
+    """Tokenize `data` from `start` to `end`, keeping the original tokens in `indata` that aren't affected by edits."""
+    positions, original_tokens = _read_tokens(indata, start, end)
+
+    def edited(start, end):
+        i = bisect_left(edit_ends, start + 1)
+        return i < len(edit_starts) and edit_starts[i] < end
+
+    tokens = []
+    pos = start
+    i = 0
+    while pos < end:
+        i = bisect_left(positions, pos, i)
+        if i < len(positions) and positions[i] == pos:
+            token = original_tokens[i]
+            if type(token) == tuple:
+                count, disp = token
+                valid = not edited(pos + disp, pos + disp + count) and not edited(pos, pos + count)
+            else:
+                count = 1
+                valid = not edited(pos, pos + 1)
+            if valid:
+                tokens.append(token)
+                pos += count
+                continue
+
+        match = _find_match(data, pos, min(end - pos, SlidingWindow.match_max))
+        if match is None:
+            tokens.append(data[pos])
+            pos += 1
+            continue
+
+        # Stop at the last token start that the match passes over, so the original tokens can be picked up from there
+        count, disp = match
+        boundary = bisect_right(positions, pos + count, i) - 1
+        if positions[boundary] != pos + count and positions[boundary] - pos >= SlidingWindow.match_min:
+            count = positions[boundary] - pos
+        tokens.append((count, disp))
+        pos += count
+
+    return tokens
+
+
+def _find_match(data: bytes | bytearray, index: int, limit: int):
+    """Find the longest match for the data at `index` in the sliding window, preferring the farthest one, in the same
+    form as `SlidingWindow.search`."""
+    start = max(index - SlidingWindow.size, 0)
+    found = None
+    count = SlidingWindow.match_min
+    while count <= limit:
+        # Overlapping matches may be found directly, as in HashChainWindow.match
+        match_start = data.find(data[index:index + count], start, index - SlidingWindow.disp_min + count)
+        if match_start < 0:
+            break
+        found = (count, match_start - index)
+        # A longer match can't start before this one
+        start = match_start
+        count += 1
+    return found
+
+
+def _add_tokens(tokens: list, data: bytes | bytearray, start: int, n: int) -> bool:
+    """Split tokens, starting at position `start`, to make `n` more of them while producing the same data. Returns
+    False if there aren't enough matches to split."""
+    pos = start
+    for i, token in enumerate(tokens):
+        if n <= 0:
+            break
+        if type(token) == tuple:
+            count, disp = token
+            if count > SlidingWindow.match_min:
+                # Take the last byte out of the match as a literal
+                tokens[i] = [(count - 1, disp), data[pos + count - 1]]
+                n -= 1
+            elif n >= 2:
+                tokens[i] = list(data[pos:pos + count])
+                n -= 2
+            pos += count
+        else:
+            pos += 1
+    tokens[:] = [t for token in tokens for t in (token if type(token) == list else (token,))]
+    return n <= 0
+
+
+def compressed_size(data: ByteString, windowclass=None, level: CompressionLevel = "greedy") -> int:
+    """Return the length of `compress(data, windowclass, level)` without building the compressed data."""
+    tokenize, windowclass = _get_tokenizer(level, windowclass)
+
+    token_count = 0
+    length = 0
+    for t in tokenize(data, windowclass):
+        token_count += 1
+        length += 2 if type(t) == tuple else 1
+    length += (token_count + 7) // 8
+
+    # header and padding
+    return 4 + length + (4 - (length % 4 or 4))
+
+
+def _get_tokenizer(level: CompressionLevel, windowclass):
+    if level == "fast":
+        return _compress, windowclass or DefaultFastWindow
+    elif level == "greedy":
+        return _compress, windowclass or DefaultWindow
+    elif level == "optimal":
+        return _compress_optimal, windowclass or DefaultWindow
+    else:
+        raise ValueError(f"Invalid compression level: {level}")
+
+
 class SlidingWindow:
     # The size of the sliding window
     size = 4096
@@ -171,7 +549,215 @@ class SlidingWindow:
         return matchlen
 
 
-def _compress(input, windowclass=SlidingWindow):
+class HashChainWindow:
+    """Match finder that chains positions by the 3 bytes starting there.
+
+    Only positions sharing the first `match_min` bytes with the search position are ever compared, and positions that
+    fall out of the window are dropped from the front of their chain. With an unbounded chain, every candidate in the
+    window is considered and ties go to the farthest match, so the output is identical to `SlidingWindow`. Setting
+    `max_chain` only checks that many of the nearest candidates, which is faster but may compress worse."""
+
+    size = SlidingWindow.size
+    disp_min = SlidingWindow.disp_min
+    match_min = SlidingWindow.match_min
+    match_max = SlidingWindow.match_max
+
+    # How many candidates to compare per search, or None to compare all of them
+    max_chain: int | None = None
+
+    def __init__(self, buf):
+        self.data = buf
+        self.chains: dict[int, deque[int]] = {}
+        self.index = 0
+
+    def _key(self, i):
+        data = self.data
+        return data[i] << 16 | data[i + 1] << 8 | data[i + 2]
+
+    def next(self):
+        i = self.index
+        if i + self.match_min <= len(self.data):
+            key = self._key(i)
+            chain = self.chains.get(key)
+            if chain is None:
+                self.chains[key] = deque((i,))
+            else:
+                chain.append(i)
+        self.index += 1
+
+    def advance(self, n=1):
+        """Advance the window by n bytes"""
+        for _ in range(n):
+            self.next()
+
+    def search(self):
+        index = self.index
+        limit = min(len(self.data) - index, self.match_max)
+        if limit < self.match_min:
+            return None
+        chain = self.chains.get(self._key(index))
+        if not chain:
+            return None
+
+        oldest = index - self.size
+        while chain and chain[0] < oldest:
+            chain.popleft()
+
+        newest = index - self.disp_min
+        best_length = 0
+        best_start = 0
+        if self.max_chain is None:
+            # Oldest first, so that the farthest of the longest matches wins
+            for start in chain:
+                if start > newest:
+                    break
+                length = self.match(start, index, limit)
+                if length > best_length:
+                    best_length = length
+                    best_start = start
+                    if length >= limit:
+                        break
+        else:
+            for depth, start in enumerate(reversed(chain)):
+                if depth >= self.max_chain:
+                    break
+                if start > newest:
+                    continue
+                length = self.match(start, index, limit)
+                if length > best_length:
+                    best_length = length
+                    best_start = start
+                    if length >= limit:
+                        break
+
+        if best_length < self.match_min:
+            return None
+        return best_length, best_start - index
+
+    def match(self, start, bufstart, limit):
+        # Overlapping matches may be compared directly: each byte past the start of the buffer repeats a byte that
+        # has already matched.
+        data = self.data
+        if data[start:start + limit] == data[bufstart:bufstart + limit]:
+            return limit
+        matchlen = self.match_min
+        while data[start + matchlen] == data[bufstart + matchlen]:
+            matchlen += 1
+        return matchlen
+
+
+class FastHashChainWindow(HashChainWindow):
+    max_chain = 8
+
+
+class NumpyHashChainWindow(HashChainWindow):
+    """Match finder that builds every hash chain up front with NumPy.
+
+    Positions are sorted by the 3 bytes starting there, so each chain is a sorted run of that order, and advancing the
+    window costs nothing. The first few candidates of a search are compared one at a time, which finds long matches in
+    repetitive data quickly; if none of them reach the longest possible match, the rest are compared at once. Candidates
+    are considered in the same order as `HashChainWindow`, so the output is identical."""
+
+    # How many candidates to compare one at a time before comparing the rest with NumPy
+    scalar_candidates = 4
+
+    def __init__(self, buf):
+        self.data = buf
+        self.index = 0
+
+        array = np.frombuffer(buf, dtype=np.uint8)
+        count = max(len(array) - self.match_min + 1, 0)
+        keys = (array[:count].astype(np.int32) << 16 |
+                array[1:count + 1].astype(np.int32) << 8 |
+                array[2:count + 2])
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        ranks = np.arange(count)
+        chain_starts = np.ones(count, dtype=bool)
+        chain_starts[1:] = sorted_keys[1:] != sorted_keys[:-1]
+        chain_starts = np.maximum.accumulate(np.where(chain_starts, ranks, 0))
+        position_ranks = np.empty(count, dtype=np.intp)
+        position_ranks[order] = ranks
+
+        self.array = array
+        self.order = order
+        # Lists are faster than arrays for single lookups
+        self.order_list: list[int] = order.tolist()
+        self.ranks: list[int] = position_ranks.tolist()
+        self.chain_starts: list[int] = chain_starts[position_ranks].tolist()
+
+    def next(self):
+        self.index += 1
+
+    def advance(self, n=1):
+        """Advance the window by n bytes"""
+        self.index += n
+
+    def search(self):
+        index = self.index
+        limit = min(len(self.data) - index, self.match_max)
+        if limit < self.match_min:
+            return None
+
+        # Earlier positions in the chain are before this one in the order
+        order = self.order_list
+        end = self.ranks[index]
+        start = bisect_left(order, index - self.size, self.chain_starts[index], end)
+
+        best_length = 0
+        best_start = 0
+        if self.max_chain is None:
+            end = bisect_right(order, index - self.disp_min, start, end)
+            scalar_end = min(end, start + self.scalar_candidates)
+            for i in range(start, scalar_end):
+                candidate = order[i]
+                length = self.match(candidate, index, limit)
+                if length > best_length:
+                    best_length = length
+                    best_start = candidate
+                    if length >= limit:
+                        break
+            else:
+                if scalar_end < end:
+                    array = self.array
+                    starts = self.order[scalar_end:end]
+                    same = array[starts[:, None] + np.arange(limit)] == array[index:index + limit]
+                    lengths = np.where(same.all(axis=1), limit, same.argmin(axis=1))
+                    i = int(lengths.argmax())
+                    if lengths[i] > best_length:
+                        best_length = int(lengths[i])
+                        best_start = int(starts[i])
+        else:
+            newest = index - self.disp_min
+            for i in range(end - 1, max(start, end - self.max_chain) - 1, -1):
+                candidate = order[i]
+                if candidate > newest:
+                    continue
+                length = self.match(candidate, index, limit)
+                if length > best_length:
+                    best_length = length
+                    best_start = candidate
+                    if length >= limit:
+                        break
+
+        if best_length < self.match_min:
+            return None
+        return best_length, best_start - index
+
+
+class FastNumpyHashChainWindow(NumpyHashChainWindow):
+    max_chain = 8
+
+
+if np is None:
+    DefaultWindow = HashChainWindow
+    DefaultFastWindow = FastHashChainWindow
+else:
+    DefaultWindow = NumpyHashChainWindow
+    DefaultFastWindow = FastNumpyHashChainWindow
+
+
+def _compress(input, windowclass=HashChainWindow):
     """Generates a stream of tokens. Either a byte (int) or a tuple of (count,
     displacement)."""
 
@@ -192,6 +778,52 @@ def _compress(input, windowclass=SlidingWindow):
             i += 1
 
 
+# Cost of each token in bits, counting its flag bit
+LITERAL_BITS = 1 + 8
+MATCH_BITS = 1 + 16
+
+
+def _compress_optimal(input, windowclass=HashChainWindow):
+    """Generates the stream of tokens with the smallest total size.
+
+    Every position gets its longest match, and any shorter length at the same displacement is also a valid token.
+    Working backwards from the end of the input, each position then keeps whichever token minimizes the cost of
+    encoding everything after it. Since the flag bits are packed into bytes, minimizing the number of bits also
+    minimizes the size of the compressed data."""
+
+    window = windowclass(input)
+    size = len(input)
+
+    matches = []
+    for _ in range(size):
+        matches.append(window.search())
+        window.next()
+
+    cost = [0] * (size + 1)
+    lengths = [1] * (size + 1)
+    for i in range(size - 1, -1, -1):
+        best_cost = cost[i + 1] + LITERAL_BITS
+        best_length = 1
+        match = matches[i]
+        if match:
+            for length in range(window.match_min, match[0] + 1):
+                match_cost = cost[i + length] + MATCH_BITS
+                if match_cost <= best_cost:
+                    best_cost = match_cost
+                    best_length = length
+        cost[i] = best_cost
+        lengths[i] = best_length
+
+    i = 0
+    while i < size:
+        length = lengths[i]
+        if length == 1:
+            yield input[i]
+        else:
+            yield length, matches[i][1]
+        i += length
+
+
 def packflags(flags):
     n = 0
     for i in range(8):
@@ -226,55 +858,86 @@ def bits(byte):
             byte & 1)
 
 
-def decompress_raw_lzss10(indata, decompressed_size, _overlay=False):
-    """Decompress LZSS-compressed bytes. Returns a bytearray."""
-    data = bytearray()
+def _flag_runs(flags):
+    """Split a flag byte into runs: the number of literal bytes, or 0 for a back-reference."""
+    runs = []
+    for flag in bits(flags):
+        if flag:
+            runs.append(0)
+        elif runs and runs[-1]:
+            runs[-1] += 1
+        else:
+            runs.append(1)
+    return tuple(runs)
 
-    it = iter(indata)
 
-    if _overlay:
-        disp_extra = 3
-    else:
-        disp_extra = 1
+FLAG_RUNS = tuple(_flag_runs(flags) for flags in range(256))
 
-    def writebyte(b):
-        data.append(b)
-
-    def readbyte():
-        return next(it)
-
-    def readshort():
-        # big-endian
-        a = next(it)
-        b = next(it)
-        return (a << 8) | b
-
-    def copybyte():
-        data.append(next(it))
-
-    while len(data) < decompressed_size:
-        b = readbyte()
-        flags = bits(b)
-        for flag in flags:
-            if flag == 0:
-                copybyte()
-            elif flag == 1:
-                sh = readshort()
-                count = (sh >> 0xc) + 3
-                disp = (sh & 0xfff) + disp_extra
 
-                for _ in range(count):
-                    writebyte(data[-disp])
-            else:
-                raise ValueError(flag)
+def decompress_raw_lzss10(indata, decompressed_size, _overlay=False, stop_at=None):
+    """Decompress LZSS-compressed bytes. Returns a bytearray.
 
-            if decompressed_size <= len(data):
-                break
+    If `stop_at` is given, decompression stops once that many bytes have been produced."""
+    if stop_at is None or stop_at > decompressed_size:
+        stop_at = decompressed_size
+    data = bytearray(stop_at)
+    _decompress_raw_lzss10_into(memoryview(indata), data, decompressed_size, _overlay, stop_at)
+    return data
 
-    if len(data) != decompressed_size:
-        raise DecompressionError("decompressed size does not match the expected size")
 
-    return data
+def _decompress_raw_lzss10_into(src, data, decompressed_size, _overlay, stop_at):
+    """Decompress the first `stop_at` bytes of LZSS-compressed bytes into the start of `data`."""
+    if _overlay:
+        disp_extra = 3
+    else:
+        disp_extra = 1
+
+    flag_runs = FLAG_RUNS
+    src_size = len(src)
+    pos = 0
+    i = 0
+    try:
+        while pos < stop_at:
+            runs = flag_runs[src[i]]
+            i += 1
+            for run in runs:
+                if run:
+                    # Copy consecutive literal bytes at once
+                    end = pos + run
+                    if end > stop_at:
+                        end = stop_at
+                        run = end - pos
+                    if i + run > src_size:
+                        raise IndexError
+                    data[pos:end] = src[i:i + run]
+                    i += run
+                    pos = end
+                else:
+                    # big-endian
+                    sh = src[i] << 8 | src[i + 1]
+                    i += 2
+                    count = (sh >> 0xc) + 3
+                    disp = (sh & 0xfff) + disp_extra
+                    if disp > pos:
+                        raise DecompressionError("back-reference before the start of the data")
+                    end = pos + count
+                    if end > decompressed_size:
+                        raise DecompressionError("decompressed size does not match the expected size")
+                    if end > stop_at:
+                        end = stop_at
+                        count = end - pos
+
+                    start = pos - disp
+                    if count <= disp:
+                        data[pos:end] = data[start:start + count]
+                    else:
+                        # The copy overlaps its own output, so it repeats the last `disp` bytes
+                        data[pos:end] = (bytes(data[start:pos]) * (count // disp + 1))[:count]
+                    pos = end
+                if pos >= stop_at:
+                    break
+    except IndexError:
+        raise DecompressionError("compressed data ended before the expected size") from None
 
 
 class DecompressionError(ValueError):
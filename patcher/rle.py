@@ -1,90 +1,380 @@
+import bisect
 import itertools
-from typing import List, Tuple, Union
+from typing import List, Optional, Tuple, Union
 
-from . import iterators
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 ByteString = Union[bytes, bytearray, memoryview]
 
+# Increment whenever a change to the encoder changes its output
+ENCODER_VERSION = 1
 
-def decompress(data: ByteString):
-    it = iter(data)
-    planes = (bytearray(), bytearray())
 
-    for plane in range(2):
-        read_length = next(it) - 1
-        if read_length not in range(2):
-            raise ValueError(f"read length = {read_length + 1}")
-        if read_length == 0:
-            count = next(it)
-        else:
-            count = next(it) << 8 | next(it)
+def decompress(data: ByteString) -> bytearray:
+    src = memoryview(data)
+    planes: list[bytearray] = []
+    i = 0
 
-        while count > 0:
+    try:
+        for _ in range(2):
+            read_length = src[i] - 1
+            i += 1
+            if read_length not in range(2):
+                raise ValueError(f"read length = {read_length + 1}")
             flag = 0x80 << (read_length * 8)
-            if count & flag:
-                copied = next(it)
-                planes[plane].extend(copied for _ in range(count & (flag - 1)))
-            else:
-                planes[plane].extend(next(it) for _ in range(count))
 
-            if read_length == 0:
-                count = next(it)
+            plane = bytearray()
+            while True:
+                if read_length == 0:
+                    count = src[i]
+                    i += 1
+                else:
+                    count = src[i] << 8 | src[i + 1]
+                    i += 2
+                if count == 0:
+                    break
+
+                if count & flag:
+                    plane.extend(bytes((src[i],)) * (count & (flag - 1)))
+                    i += 1
+                else:
+                    if i + count > len(src):
+                        raise IndexError
+                    plane.extend(src[i:i + count])
+                    i += count
+            planes.append(plane)
+    except IndexError:
+        raise ValueError("compressed data ended before the end of the plane") from None
+
+    lo, hi = planes
+    if len(lo) != len(hi):
+        raise ValueError(f"plane lengths differ: {len(lo)} and {len(hi)}")
+    decompressed = bytearray(2 * len(lo))
+    decompressed[0::2] = lo
+    decompressed[1::2] = hi
+    return decompressed
+
+
+def _run_lengths(plane: ByteString) -> List[Tuple[int, int]]:
+    """Count runs of the same value."""
+    if np is not None:
+        values = np.frombuffer(bytes(plane), dtype=np.uint8)
+        starts = np.flatnonzero(np.diff(values)) + 1
+        starts = np.concatenate(((0,), starts)) if len(values) else starts
+        lengths = np.diff(np.append(starts, len(values)))
+        return list(zip(values[starts].tolist(), lengths.tolist()))
+    return [(value, sum(1 for _ in run)) for value, run in itertools.groupby(plane)]
+
+
+def _encoded_size(run_lengths: List[Tuple[int, int]], read_length: int) -> int:
+    """Count the bytes that encoding a plane with the given read length produces."""
+    width = read_length + 1
+    min_run_length = 3 + read_length
+    max_run_length = (0x80 << (8 * read_length)) - 1
+
+    size = 1
+    unique = 0
+    for _, run_length in run_lengths:
+        while run_length > 0:
+            if run_length >= min_run_length:
+                if unique > 0:
+                    size += width + unique
+                    unique = 0
+                size += width + 1
             else:
-                count = next(it) << 8 | next(it)
+                if unique + run_length > max_run_length:
+                    size += width + unique
+                    unique = 0
+                unique += run_length
+            run_length -= max_run_length
+    if unique > 0:
+        size += width + unique
+    return size + width
+
 
-    return bytearray(iterators.interleave(*planes))
+def compressed_size(data: ByteString) -> int:
+    """Return the length of `compress(data)` without building the compressed data."""
+    return sum(
+        min(_encoded_size(run_lengths, read_length) for read_length in range(2))
+        for run_lengths in (_run_lengths(data[0::2]), _run_lengths(data[1::2]))
+    )
 
 
 def compress(data: ByteString):
-    t1, t2 = itertools.tee(iterators.batched(data, 2))
-    lo = (t[0] for t in t1)
-    hi = (t[1] for t in t2)
     compressed = bytearray()
 
-    for plane in (lo, hi):
-        # Count runs of the same value
-        run_lengths: List[Tuple[int, int]] = []
-        count = 1
-        for prev, curr in iterators.pairwise(plane):
-            if prev == curr:
-                count += 1
+    for plane in (data[0::2], data[1::2]):
+        run_lengths = _run_lengths(plane)
+        # Only encode with the read length that gives the shorter result
+        read_length = min(range(2), key=lambda read_length: _encoded_size(run_lengths, read_length))
+        _encode_plane(run_lengths, read_length, compressed)
+
+    return bytes(compressed)
+
+
+def _encode_plane(run_lengths: List[Tuple[int, int]], read_length: int, buffer: bytearray):
+    min_run_length = 3 + read_length
+    flag = 0x80 << (8 * read_length)
+    max_run_length = flag - 1
+    unique = bytearray()
+
+    buffer.append(read_length + 1)
+
+    def flush_unique():
+        buffer.extend(len(unique).to_bytes(read_length + 1, 'big'))
+        buffer.extend(unique)
+        unique.clear()
+
+    for value, run_length in run_lengths:
+        while run_length > 0:
+            if run_length >= min_run_length:
+                if len(unique) > 0:  # Preceded by unique values
+                    flush_unique()
+                length = flag | min(run_length, max_run_length)
+                buffer.extend(length.to_bytes(read_length + 1, 'big'))
+                buffer.append(value)
             else:
-                run_lengths.append((prev, count))
-                count = 1
-        run_lengths.append((curr, count))
-
-        # Try each read length
-        buffers = (bytearray(), bytearray())
-        for read_length, buffer in enumerate(buffers):
-            min_run_length = 3 + read_length
-            flag = 0x80 << (8 * read_length)
-            max_run_length = flag - 1
-            unique = bytearray()
-
-            buffer.append(read_length + 1)
-
-            def flush_unique():
-                buffer.extend(len(unique).to_bytes(read_length + 1, 'big'))
-                buffer.extend(unique)
-                unique.clear()
-
-            for value, run_length in run_lengths:
-                while run_length > 0:
-                    if run_length >= min_run_length:
-                        if len(unique) > 0:  # Preceded by unique values
-                            flush_unique()
-                        length = flag | min(run_length, max_run_length)
-                        buffer.extend(length.to_bytes(read_length + 1, 'big'))
-                        buffer.append(value)
+                if len(unique) + run_length > max_run_length:  # Total count would be too long
+                    flush_unique()
+                unique.extend([value] * run_length)
+            run_length -= max_run_length
+    if len(unique) > 0:
+        flush_unique()
+    buffer.extend((0).to_bytes(read_length + 1, 'big'))
+
+
+class RunIndex:
+    """
+    The packets of RLE-compressed data, indexed by where each starts in its plane of decompressed data, so that bytes
+    can be read and changed without decompressing or compressing all of the data. Offsets are into the decompressed
+    data, with the planes interleaved.
+
+    Changing a byte of a run splits the run, and the pieces are merged with neighboring unique values where possible.
+    Packets that are never changed are kept exactly as they were, so only the part of the compressed data from the
+    first changed packet onward needs to be written again.
+    """
+
+    read_lengths: List[int]
+    plane_lengths: List[int]
+    # Per plane: where each packet starts, each packet's unique values or (value, run length), and each packet's
+    # original encoding, or None if it has been changed
+    starts: List[List[int]]
+    packets: List[List[Union[bytearray, Tuple[int, int]]]]
+    encoded: List[List[Optional[bytes]]]
+    original_size: int
+    # Where each value of each packet was in the original compressed data, and the packet's plane, start, and length
+    _value_offsets: List[int]
+    _value_packets: List[Tuple[int, int, int]]
+
+    def __init__(self, data: ByteString):
+        src = memoryview(data)
+        self.read_lengths = []
+        self.plane_lengths = []
+        self.starts = []
+        self.packets = []
+        self.encoded = []
+        self._value_offsets = []
+        self._value_packets = []
+        i = 0
+
+        try:
+            for plane in range(2):
+                read_length = src[i] - 1
+                i += 1
+                if read_length not in range(2):
+                    raise ValueError(f"read length = {read_length + 1}")
+                flag = 0x80 << (read_length * 8)
+
+                starts = []
+                packets = []
+                encoded = []
+                pos = 0
+                while True:
+                    packet_start = i
+                    if read_length == 0:
+                        count = src[i]
+                        i += 1
                     else:
-                        if len(unique) + run_length > max_run_length:  # Total count would be too long
-                            flush_unique()
-                        unique.extend([value] * run_length)
-                    run_length -= max_run_length
-            if len(unique) > 0:
-                flush_unique()
-            buffer.extend((0).to_bytes(read_length + 1, 'big'))
-            # Copy the shorter one
-            compressed.extend(min(buffers, key=len))
+                        count = src[i] << 8 | src[i + 1]
+                        i += 2
+                    if count == 0:
+                        break
 
-    return bytes(compressed)
+                    starts.append(pos)
+                    self._value_offsets.append(i)
+                    if count & flag:
+                        length = count & (flag - 1)
+                        packets.append((src[i], length))
+                        self._value_packets.append((plane, pos, 0))
+                        i += 1
+                    else:
+                        if i + count > len(src):
+                            raise IndexError
+                        length = count
+                        packets.append(bytearray(src[i:i + count]))
+                        self._value_packets.append((plane, pos, length))
+                        i += count
+                    encoded.append(src[packet_start:i].tobytes())
+                    pos += length
+
+                self.read_lengths.append(read_length)
+                self.plane_lengths.append(pos)
+                self.starts.append(starts)
+                self.packets.append(packets)
+                self.encoded.append(encoded)
+        except IndexError:
+            raise ValueError("compressed data ended before the end of the plane") from None
+
+        if self.plane_lengths[0] != self.plane_lengths[1]:
+            raise ValueError(f"plane lengths differ: {self.plane_lengths[0]} and {self.plane_lengths[1]}")
+        self.original_size = i
+
+    def __len__(self):
+        return sum(self.plane_lengths)
+
+    def _find(self, offset: int) -> Tuple[int, int, int]:
+        """Find the plane, packet, and position in the plane of a byte of the decompressed data."""
+        if offset not in range(len(self)):
+            raise IndexError(f"offset {offset} out of range")
+        plane = offset & 1
+        pos = offset >> 1
+        return plane, bisect.bisect_right(self.starts[plane], pos) - 1, pos
+
+    def decompressed_offset(self, compressed_offset: int, unique_only: bool = False) -> int:
+        """
+        Find where a byte of the original compressed data ends up in the decompressed data. The byte must be one of a
+        packet's values; for a run, this is where the run starts. If `unique_only` is set, the byte must not be the
+        value of a run, since changing it would change every byte of the run.
+        """
+        i = bisect.bisect_right(self._value_offsets, compressed_offset) - 1
+        if i >= 0:
+            plane, start, length = self._value_packets[i]
+            value_index = compressed_offset - self._value_offsets[i]
+            if unique_only and length == 0 and value_index == 0:
+                raise ValueError(f"Compressed data at offset 0x{compressed_offset:x} is the value of a run")
+            if value_index == 0 or value_index < length:
+                return 2 * (start + value_index) + plane
+        raise ValueError(f"Compressed data at offset 0x{compressed_offset:x} is not part of a packet's values")
+
+    def __getitem__(self, offset: int) -> int:
+        plane, i, pos = self._find(offset)
+        packet = self.packets[plane][i]
+        if type(packet) is bytearray:
+            return packet[pos - self.starts[plane][i]]
+        return packet[0]
+
+    def __setitem__(self, offset: int, value: int):
+        plane, i, pos = self._find(offset)
+        starts = self.starts[plane]
+        packets = self.packets[plane]
+        packet = packets[i]
+        if type(packet) is bytearray:
+            if packet[pos - starts[i]] != value:
+                packet[pos - starts[i]] = value
+                self.encoded[plane][i] = None
+            return
+
+        run_value, length = packet
+        if run_value == value:
+            return
+        before = pos - starts[i]
+        after = length - before - 1
+        pieces = [(run_value, before), (value, 1), (run_value, after)]
+
+        # Take in neighboring unique values, so the pieces can be merged with them
+        start = i
+        end = i + 1
+        if start > 0 and type(packets[start - 1]) is bytearray:
+            start -= 1
+            pieces.insert(0, packets[start])
+        if end < len(packets) and type(packets[end]) is bytearray:
+            pieces.append(packets[end])
+            end += 1
+
+        read_length = self.read_lengths[plane]
+        min_run_length = 3 + read_length
+        max_run_length = (0x80 << (8 * read_length)) - 1
+        new_packets: List[Union[bytearray, Tuple[int, int]]] = []
+        for piece in pieces:
+            if type(piece) is tuple:
+                piece_value, piece_length = piece
+                if piece_length == 0:
+                    continue
+                if piece_length >= min_run_length:
+                    new_packets.append(piece)
+                    continue
+                piece = bytearray((piece_value,)) * piece_length
+            previous = new_packets[-1] if new_packets else None
+            if type(previous) is bytearray and len(previous) + len(piece) <= max_run_length:
+                previous += piece
+            else:
+                new_packets.append(bytearray(piece))
+
+        new_starts = []
+        pos = starts[start]
+        for new_packet in new_packets:
+            new_starts.append(pos)
+            pos += len(new_packet) if type(new_packet) is bytearray else new_packet[1]
+        packets[start:end] = new_packets
+        starts[start:end] = new_starts
+        self.encoded[plane][start:end] = [None] * len(new_packets)
+
+    def _encode_packet(self, plane: int, packet: Union[bytearray, Tuple[int, int]]) -> bytes:
+        width = self.read_lengths[plane] + 1
+        if type(packet) is bytearray:
+            return len(packet).to_bytes(width, 'big') + packet
+        value, length = packet
+        flag = 0x80 << (8 * self.read_lengths[plane])
+        return (flag | length).to_bytes(width, 'big') + bytes((value,))
+
+    def _encode(self) -> Tuple[bytearray, Optional[int], Optional[int]]:
+        """Encode all of the packets. Returns the compressed data and the range of it that was changed."""
+        compressed = bytearray()
+        first_changed = None
+        last_changed = None
+        for plane in range(2):
+            compressed.append(self.read_lengths[plane] + 1)
+            for packet, encoded in zip(self.packets[plane], self.encoded[plane]):
+                if encoded is None:
+                    if first_changed is None:
+                        first_changed = len(compressed)
+                    compressed.extend(self._encode_packet(plane, packet))
+                    last_changed = len(compressed)
+                else:
+                    compressed.extend(encoded)
+            compressed.extend(bytes(self.read_lengths[plane] + 1))
+        return compressed, first_changed, last_changed
+
+    def to_bytes(self) -> bytes:
+        return bytes(self._encode()[0])
+
+    def changes(self) -> Tuple[int, bytes, int]:
+        """
+        Find what has to be written over the original compressed data to change it to the current compressed data.
+        Returns the offset to write at, the data to write there, and the size of the current compressed data. If the
+        size has changed, everything after the first changed packet is written.
+        """
+        compressed, first_changed, last_changed = self._encode()
+        if first_changed is None:
+            return len(compressed), b"", len(compressed)
+        if len(compressed) != self.original_size:
+            last_changed = len(compressed)
+        return first_changed, bytes(compressed[first_changed:last_changed]), len(compressed)
+
+    def decompress(self) -> bytearray:
+        planes = []
+        for packets in self.packets:
+            plane = bytearray()
+            for packet in packets:
+                if type(packet) is bytearray:
+                    plane.extend(packet)
+                else:
+                    plane.extend(bytes((packet[0],)) * packet[1])
+            planes.append(plane)
+        decompressed = bytearray(len(self))
+        decompressed[0::2] = planes[0]
+        decompressed[1::2] = planes[1]
+        return decompressed
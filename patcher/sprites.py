@@ -95,6 +95,10 @@ def get_tile(tiledata: bytes, x: int, y: int) -> bytes:
     return tiledata[offset:offset+0x20]
 
 
+def get_tile_end(x: int, y: int) -> int:
+    return 0x20 * (x + 1) + 0x400 * y
+
+
 def get_sprites(tileset: bytes, start_x: int, start_y: int, sprites: int, rows: int = 2):
     return b"".join(get_tile(tileset, 2 * t + x, y)
                     for t in range(sprites)
@@ -102,6 +106,11 @@ def get_sprites(tileset: bytes, start_x: int, start_y: int, sprites: int, rows:
                     for x in range(start_x, start_x + 2))
 
 
+def get_sprites_end(start_x: int, start_y: int, sprites: int, rows: int = 2) -> int:
+    """Length of tile data needed to extract sprites with get_sprites()."""
+    return get_tile_end(start_x + 2 * sprites - 1, start_y + rows - 1)
+
+
 def make_4_frame_animation(data: bytes):
     middle_frame = data[0x80:0x100]
     return data + middle_frame
@@ -131,15 +140,16 @@ UNKNOWN_STATUES = [
 def write_decompressed_item_sprites(rom: LocalRom):
     # This extracts the sprites for the vanilla items and writes them into some reserved space in uncompressed format
     # using the same tile layout as the tank graphics.
+    # Only as much of each sheet as contains the needed tiles is decompressed.
 
     for statue_name, item_name in CHOZO_STATUES:
-        statue_gfx = rom.decompress_lzss(get_rom_address(f"sChozoStatue{statue_name}Gfx"))
+        statue_gfx = rom.decompress_lzss(get_rom_address(f"sChozoStatue{statue_name}Gfx"), get_sprites_end(4, 4, 3))
         item_gfx = get_sprites(statue_gfx, 4, 4, 3)
         item_gfx = make_4_frame_animation(item_gfx)
         rom.write(get_rom_address(f"sRando{item_name}Gfx"), item_gfx)
 
     for item_name, y_offset in UNKNOWN_STATUES:
-        statue_gfx = rom.decompress_lzss(get_rom_address(f"sChozoStatue{item_name}Gfx"))
+        statue_gfx = rom.decompress_lzss(get_rom_address(f"sChozoStatue{item_name}Gfx"), get_sprites_end(4, 4, 2))
         tiles = get_sprites(statue_gfx, 4, 4, 2)
         byte_offset = y_offset * 4
         # Move the graphics down by `y_offset` pixels
@@ -151,7 +161,7 @@ def write_decompressed_item_sprites(rom: LocalRom):
         rom.write(get_rom_address(f"sRandoUnknown{item_name}Gfx"), item_gfx)
 
     # Charge Beam
-    charge = rom.decompress_lzss(get_rom_address("sChargeBeamGfx"))
+    charge = rom.decompress_lzss(get_rom_address("sChargeBeamGfx"), max(get_sprites_end(20, 0, 1), get_tile_end(22, 0)))
     charge1 = get_sprites(charge, 18, 0, 1)
     charge2 = get_sprites(charge, 20, 0, 1)
     charge3 = bytearray(charge1)
@@ -159,7 +169,7 @@ def write_decompressed_item_sprites(rom: LocalRom):
     rom.write(get_rom_address("sRandoChargeBeamGfx"), charge1 + charge2 + charge3 + charge2)
 
     # Morph Ball
-    morph = rom.decompress_lzss(get_rom_address("sMorphBallGfx"))
+    morph = rom.decompress_lzss(get_rom_address("sMorphBallGfx"), get_sprites_end(6, 0, 1))
     morph_core = get_sprites(morph, 0, 0, 3)
     morph_glass = get_sprites(morph, 6, 0, 1)
     morph_composited = bytearray(len(morph_core))
@@ -179,6 +189,6 @@ def write_decompressed_item_sprites(rom: LocalRom):
     rom.write(get_rom_address("sRandoMorphBallGfx"), make_4_frame_animation(morph_composited))
 
     # Power Grip
-    powergrip = rom.decompress_lzss(get_rom_address("sPowerGripGfx"))
+    powergrip = rom.decompress_lzss(get_rom_address("sPowerGripGfx"), get_sprites_end(0, 0, 3))
     powergrip = get_sprites(powergrip, 0, 0, 3)
     rom.write(get_rom_address("sRandoPowerGripGfx"), make_4_frame_animation(powergrip))
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+from bisect import bisect_right
 import json
 import pkgutil
 
@@ -19,9 +20,18 @@ def _get_symbols():
 
 _get_symbols()
 symbols = ram_symbols | rom_symbols
+_rom_symbol_addresses = sorted(set(rom_symbols.values()))
 
 
 def get_symbol(symbol: str, offset: int = 0) -> int:
     """Convert a label name and offset to an address in GBA address space."""
 
     return symbols[symbol] + offset
+
+
+def get_symbol_end(symbol: str) -> int:
+    """The address of the next ROM label after `symbol`, which is where the data at `symbol` ends at the latest."""
+    i = bisect_right(_rom_symbol_addresses, rom_symbols[symbol])
+    if i == len(_rom_symbol_addresses):
+        raise ValueError(f"No label after {symbol}")
+    return _rom_symbol_addresses[i]
@@ -0,0 +1,382 @@
+import random
+import tempfile
+import threading
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import patch
+
+from ..patcher import codecs, compression, lz10, rle
+from ..patcher.backgrounds import BackgroundInfo, BackgroundProperties, BackgroundTilemap, deferred_tilemap_writes
+from ..patcher.local_rom import LocalRom
+
+
+def make_sample(size: int, seed: int = 0) -> bytes:
+    """Build data with a mix of runs, repeats, and noise, similar to graphics and tilemaps."""
+    rng = random.Random(seed)
+    data = bytearray()
+    while len(data) < size:
+        kind = rng.random()
+        if kind < 0.3:
+            data.extend(bytes([rng.randrange(256)]) * rng.randrange(1, 40))
+        elif kind < 0.6 and len(data) > 20:
+            start = rng.randrange(len(data))
+            data.extend(data[start:start + rng.randrange(1, 30)])
+        else:
+            data.extend(rng.randrange(16) for _ in range(rng.randrange(1, 20)))
+    return bytes(data[:size])
+
+
+SAMPLES = [
+    b"",
+    b"ab",
+    b"aaaa",
+    bytes(0x1400),
+    bytes(range(256)) * 20,
+    make_sample(0x200, 1),
+    make_sample(0x2000, 2),
+]
+
+
+CLIPDATA_SAMPLE = bytes(
+    random.Random(3).choice((0x00, 0x00, 0x00, 0x10, 0x10, 0x5C, 0x11)) if i % 2 == 0 else 0 for i in range(0x800)
+)
+
+
+class MZMTestLZ10(TestCase):
+    def test_hash_chain_matches_reference(self):
+        """Ensure the default match finder produces the same output as the reference sliding window."""
+        for i, data in enumerate(SAMPLES):
+            with self.subTest(i):
+                self.assertEqual(lz10.compress(data, lz10.SlidingWindow), lz10.compress(data))
+
+    def test_numpy_matches_reference(self):
+        """Ensure the NumPy match finder produces the same output as the pure Python one at every level."""
+        if lz10.np is None:
+            return
+        for i, data in enumerate(SAMPLES):
+            for level, windowclass, reference in (
+                ("fast", lz10.FastNumpyHashChainWindow, lz10.FastHashChainWindow),
+                ("greedy", lz10.NumpyHashChainWindow, lz10.HashChainWindow),
+                ("optimal", lz10.NumpyHashChainWindow, lz10.HashChainWindow),
+            ):
+                with self.subTest(i, level=level):
+                    self.assertEqual(lz10.compress(data, reference, level), lz10.compress(data, windowclass, level))
+
+    def test_round_trip(self):
+        class ShortChainWindow(lz10.HashChainWindow):
+            max_chain = 4
+
+        for i, data in enumerate(SAMPLES):
+            for windowclass in (lz10.HashChainWindow, ShortChainWindow):
+                with self.subTest(i, windowclass=windowclass.__name__):
+                    self.assertEqual(data, lz10.decompress(lz10.compress(data, windowclass)))
+
+    def test_optimal_is_smallest(self):
+        """Ensure optimal parsing round trips and never loses to the greedy parse."""
+        for i, data in enumerate(SAMPLES):
+            with self.subTest(i):
+                compressed = lz10.compress(data, level="optimal")
+                self.assertEqual(data, lz10.decompress(compressed))
+                self.assertLessEqual(len(compressed), len(lz10.compress(data)))
+
+    def test_streaming(self):
+        """Ensure feeding data in pieces gives the same output as compressing it all at once."""
+        for i, data in enumerate(SAMPLES):
+            for level in ("fast", "greedy"):
+                with self.subTest(i, level=level):
+                    encoder = lz10.LZ10Encoder(bytearray(b"abc"), level)
+                    for start in range(0, len(data), 7):
+                        encoder.feed(memoryview(data)[start:start + 7])
+                    self.assertEqual(b"abc" + lz10.compress(data, level=level), encoder.finish())
+
+    def test_recompress(self):
+        """Ensure recompressing edited data round trips, whether or not the edits are near each other or the ends."""
+        data = SAMPLES[-1]
+        compressed = lz10.compress(data)
+        for edits in ([], [(0, 1)], [(0x100, 0x160)], [(0x10, 0x20), (0x18, 0x40), (0x1FF0, 0x2000)]):
+            with self.subTest(edits=edits):
+                edited = bytearray(data)
+                for start, end in edits:
+                    edited[start:end] = make_sample(end - start, start)
+                self.assertEqual(edited, lz10.decompress(lz10.recompress(compressed, edited, edits)))
+
+    def test_truncated_data(self):
+        compressed = lz10.compress(SAMPLES[-1])
+        with self.assertRaises(lz10.DecompressionError):
+            lz10.decompress(compressed[:len(compressed) // 2])
+
+    def test_decompress_prefix(self):
+        data = SAMPLES[-1]
+        compressed = lz10.compress(data)
+        for stop_at in (0, 1, 0x100, len(data) - 1, len(data), len(data) + 1):
+            with self.subTest(stop_at=stop_at):
+                self.assertEqual(data[:stop_at], lz10.decompress_prefix(compressed, stop_at))
+
+    def test_decompress_into(self):
+        data = SAMPLES[-1]
+        compressed = lz10.compress(data)
+        buffer = bytearray(len(data) + 4)
+        self.assertEqual(len(data), lz10.decompress_into(compressed, memoryview(buffer)[2:]))
+        self.assertEqual(bytes(2) + data + bytes(2), buffer)
+        with self.assertRaises(ValueError):
+            lz10.decompress_into(compressed, bytearray(len(data) - 1))
+
+    def test_compressed_size(self):
+        for i, data in enumerate(SAMPLES):
+            for level in ("fast", "greedy", "optimal"):
+                with self.subTest(i, level=level):
+                    self.assertEqual(len(lz10.compress(data, level=level)), lz10.compressed_size(data, level=level))
+
+
+class MZMTestRLE(TestCase):
+    def test_round_trip(self):
+        for i, data in enumerate((CLIPDATA_SAMPLE, bytes(0x1000), SAMPLES[-1])):
+            with self.subTest(i):
+                compressed = rle.compress(data)
+                self.assertEqual(data, rle.decompress(compressed))
+                self.assertEqual(len(compressed), rle.compressed_size(data))
+
+    def test_run_index(self):
+        """Ensure edits through a run index match edits to the decompressed data, and that writing only the changes
+        over the original compressed data gives the edited compressed data."""
+        data = bytearray(CLIPDATA_SAMPLE)
+        compressed = rle.compress(data)
+        index = rle.RunIndex(compressed)
+        self.assertEqual(data, index.decompress())
+
+        rng = random.Random(4)
+        for _ in range(20):
+            offset = rng.randrange(len(data))
+            value = rng.choice((0x00, 0x10, 0x36))
+            data[offset] = value
+            index[offset] = value
+            self.assertEqual(value, index[offset])
+        self.assertEqual(data, index.decompress())
+        self.assertEqual(data, rle.decompress(index.to_bytes()))
+
+        offset, changes, size = index.changes()
+        patched = bytearray(compressed)
+        patched[offset:offset + len(changes)] = changes
+        self.assertEqual(index.to_bytes(), patched[:size])
+
+    def test_decompressed_offset(self):
+        """Ensure every value in the compressed data maps to where it is decompressed, and nothing else maps at all."""
+        data = CLIPDATA_SAMPLE
+        compressed = rle.compress(data)
+        index = rle.RunIndex(compressed)
+        mapped = 0
+        for offset, value in enumerate(compressed):
+            try:
+                decompressed_offset = index.decompressed_offset(offset)
+            except ValueError:
+                continue
+            self.assertEqual(value, data[decompressed_offset])
+            mapped += 1
+        self.assertGreater(mapped, 0)
+        with self.assertRaises(ValueError):
+            index.decompressed_offset(0)
+
+    def test_decompressed_offset_unique_only(self):
+        """Ensure a run's value is rejected when a single byte is asked for, and unique values are not."""
+        # The low bytes are a run and then unique values, and the high bytes are all one run
+        data = bytes(b for i in range(0x20) for b in ((0x7F if i < 0x10 else i), 0))
+        index = rle.RunIndex(rle.compress(data))
+        run_offset = index._value_offsets[0]
+        self.assertEqual(0, index.decompressed_offset(run_offset))
+        with self.assertRaises(ValueError):
+            index.decompressed_offset(run_offset, unique_only=True)
+        unique_offset = index._value_offsets[1]
+        self.assertEqual(0x20, index.decompressed_offset(unique_offset + 0, unique_only=True))
+        self.assertEqual(0x22, index.decompressed_offset(unique_offset + 1, unique_only=True))
+
+    def test_without_numpy(self):
+        for i, data in enumerate((CLIPDATA_SAMPLE, bytes(0x1000), SAMPLES[-1])):
+            with self.subTest(i):
+                compressed = rle.compress(data)
+                with patch.object(rle, "np", None):
+                    self.assertEqual(compressed, rle.compress(data))
+
+    def test_truncated_data(self):
+        compressed = rle.compress(CLIPDATA_SAMPLE)
+        with self.assertRaises(ValueError):
+            rle.decompress(compressed[:len(compressed) // 2])
+
+
+class MZMTestCompressionCache(TestCase):
+    def test_disk_cache(self):
+        """Ensure cached results survive clearing the in-memory cache when a directory is set."""
+        with tempfile.TemporaryDirectory() as directory:
+            cache = compression.CompressionCache(directory=Path(directory))
+            data = SAMPLES[-1]
+            compressed = cache.get_or_compress("lz10-greedy", lz10.ENCODER_VERSION, data, lz10.compress)
+            self.assertEqual(lz10.compress(data), compressed)
+
+            cache.clear()
+            cached = cache.get_or_compress("lz10-greedy", lz10.ENCODER_VERSION, data, self.fail)
+            self.assertEqual(compressed, cached)
+
+    def test_invalid_disk_entries(self):
+        """Ensure truncated or wrong results in the cache directory are deleted instead of used."""
+        data = SAMPLES[-1]
+        with tempfile.TemporaryDirectory() as directory:
+            cache = compression.CompressionCache(directory=Path(directory))
+            key = cache.key("lz10-greedy", lz10.ENCODER_VERSION, data)
+            compressed = cache.get_or_compress("lz10-greedy", lz10.ENCODER_VERSION, data, lz10.compress)
+            for invalid in (compressed[:len(compressed) // 2], lz10.compress(SAMPLES[-2])):
+                with self.subTest(invalid=invalid):
+                    cache.clear()
+                    cache._path(key).write_bytes(invalid)
+                    with self.assertLogs(level="WARNING"):
+                        self.assertIsNone(cache.get(key))
+                    self.assertFalse(cache._path(key).exists())
+
+    def test_failed_disk_write(self):
+        """Ensure a failed write leaves no temporary file behind and the result is still cached in memory."""
+        with tempfile.TemporaryDirectory() as directory:
+            cache = compression.CompressionCache(directory=Path(directory))
+            key = cache.key("rle", rle.ENCODER_VERSION, b"ab")
+            with patch.object(compression.os, "replace", side_effect=OSError):
+                cache.put(key, rle.compress(b"ab"))
+            self.assertEqual([], [path for path in Path(directory).rglob("*") if path.is_file()])
+            self.assertEqual(rle.compress(b"ab"), cache.get(key))
+
+    def test_compress_many(self):
+        """Ensure compressing in a process pool gives the same results in the same order."""
+        cache = compression.CompressionCache()
+        inputs = SAMPLES[1:] + SAMPLES[:1]
+        results = cache.get_or_compress_many("lz10-greedy", lz10.ENCODER_VERSION, inputs, lz10.compress, workers=2)
+        self.assertEqual([lz10.compress(data) for data in inputs], results)
+
+    def test_compress_parts_to_fit(self):
+        data = SAMPLES[-1]
+        parts = (data[:0x20], data[0x20:0x80], memoryview(data)[0x80:])
+        for budget in (None, 0):
+            with self.subTest(budget=budget):
+                # Both share cache entries, so clear them to test compressing the parts
+                compression.cache.clear()
+                compressed = compression.compress_lz10_parts_to_fit(parts, budget)
+                compression.cache.clear()
+                self.assertEqual(compression.compress_lz10_to_fit(data, budget), compressed)
+
+    def test_compress_to_fit(self):
+        """Ensure slower levels are only used when the faster ones don't fit."""
+        data = SAMPLES[-1]
+        fast = lz10.compress(data, level="fast")
+        optimal = lz10.compress(data, level="optimal")
+        self.assertEqual(fast, compression.compress_lz10_to_fit(data, None))
+        self.assertEqual(fast, compression.compress_lz10_to_fit(data, len(fast)))
+        self.assertEqual(optimal, compression.compress_lz10_to_fit(data, 0))
+        self.assertEqual([fast, optimal], compression.compress_lz10_many_to_fit([data, data], [len(fast), 0]))
+        # Nothing fits in no space, so only the smallest level is tried
+        compression.cache.clear()
+        with patch.object(compression, "compress_lz10_many", wraps=compression.compress_lz10_many) as compress_many:
+            self.assertEqual([fast, optimal], compression.compress_lz10_many_to_fit([data, data], [None, 0]))
+        self.assertEqual(["fast", "optimal"], [call.args[1] for call in compress_many.call_args_list])
+
+    def test_verify(self):
+        """Ensure verification reports where compressed data decompresses differently."""
+        data = bytes(0x100) + b"ab" + bytes(0x100)
+        compress = rle.compress
+
+        def compress_wrong(data: bytes):
+            return compress(data[:0x101] + b"x" + data[0x102:])
+
+        with patch.object(compression, "verify", True), patch.object(rle, "compress", compress_wrong):
+            compression.cache.clear()
+            with self.assertRaisesRegex(compression.VerificationError, "offset 0x101"):
+                compression.compress_rle(data)
+        compression.cache.clear()
+
+    def test_changed_ranges(self):
+        original = bytes(0x100)
+        edited = bytearray(original)
+        edited[0x3F:0x42] = b"abc"
+        edited[0x80] = 1
+        edited[0xFF] = 2
+        self.assertEqual([(0x3F, 0x42), (0x80, 0x81), (0xFF, 0x100)], compression.changed_ranges(original, edited))
+        self.assertEqual([], compression.changed_ranges(original, original))
+        with self.assertRaises(ValueError):
+            compression.changed_ranges(original, original[1:])
+
+    def test_first_difference(self):
+        self.assertEqual(0, compression.first_difference(b"abc", b"xbc"))
+        self.assertEqual(2, compression.first_difference(b"abc", b"abd"))
+        self.assertEqual(2, compression.first_difference(b"ab", b"abc"))
+        self.assertEqual(3, compression.first_difference(b"abc", b"abc"))
+
+
+class MZMTestCodecs(TestCase):
+    def test_get_codec(self):
+        """Ensure the fastest codec with the required capabilities is picked, preferring ones with more of them."""
+        fast_rle = codecs.RLE._replace(name="fast rle", capabilities=codecs.Capability.NONE, cost=0.5)
+        with patch.dict(codecs._registry, clear=True):
+            codecs.register(0x10, codecs.RLE)
+            codecs.register(0x10, fast_rle)
+            codecs.register(0x40, codecs.LZ10)
+            self.assertEqual(fast_rle, codecs.get_codec(0x10))
+            self.assertEqual(fast_rle, codecs.get_codec(0x31))
+            self.assertEqual(codecs.RLE, codecs.get_codec(0x10, codecs.Capability.IN_PLACE_EDIT))
+            self.assertEqual(codecs.RLE, codecs.get_codec(0x10, preferred=codecs.Capability.PARTIAL_DECODE))
+            self.assertEqual(codecs.LZ10, codecs.get_codec(0x45, preferred=codecs.Capability.PARTIAL_DECODE))
+            with self.assertRaises(ValueError):
+                codecs.get_codec(0x40, codecs.Capability.IN_PLACE_EDIT)
+            with self.assertRaises(ValueError):
+                codecs.get_codec(0)
+
+    def test_benchmark(self):
+        with patch.dict(codecs._registry, clear=True):
+            codecs.register(0x10, codecs.RLE._replace(cost=100))
+            times = codecs.benchmark(0x10, CLIPDATA_SAMPLE, repeat=1)
+            self.assertEqual(["rle"], list(times))
+            self.assertEqual(times["rle"], codecs.get_codec(0x10).cost)
+
+
+class MZMTestDeferredWrites(TestCase):
+    def make_rom(self) -> tuple[LocalRom, BackgroundInfo]:
+        """A ROM with one LZ10 tilemap at 0x100, pointed to from 0."""
+        rom = LocalRom((0x8000100).to_bytes(4, "little") + bytes(0xFC) + bytes(4) + lz10.compress(bytes(0x800)))
+        return rom, BackgroundInfo(rom, BackgroundProperties.LZ77_COMPRESSED, 0x8000100)
+
+    def write_tile(self, info: BackgroundInfo):
+        tilemap = BackgroundTilemap.from_info(info, 0x100)
+        tilemap.set(0, 0, 0x1234)
+        tilemap.write(info.rom, 0, info.rom_address())
+
+    def test_fits(self):
+        """Ensure fits() agrees with where the tilemap is written, and writing it afterward doesn't compress it again."""
+        rom, info = self.make_rom()
+        tilemap = BackgroundTilemap.from_info(info, 0x100)
+        tilemap.set(0, 0, 0x1234)
+        size = len(tilemap.to_compressed_data())
+        self.assertTrue(tilemap.fits(size))
+        self.assertFalse(tilemap.fits(size - 1))
+        self.assertFalse(tilemap.fits(0))
+        with patch.object(lz10, "compress", side_effect=self.fail):
+            tilemap.write(rom, 0, info.rom_address())
+        self.assertEqual(0x8000100, rom.read_u32(0))
+
+    def test_read_before_write(self):
+        rom, info = self.make_rom()
+        with deferred_tilemap_writes():
+            self.write_tile(info)
+            with self.assertRaises(AssertionError):
+                BackgroundTilemap.from_info(info)
+        self.assertEqual(0x1234, BackgroundTilemap.from_info(info).tile_at(0, 0))
+
+    def test_threads(self):
+        """Ensure writes deferred in another thread are written when that thread's context exits."""
+        rom, info = self.make_rom()
+        _, other_info = self.make_rom()
+
+        def patch_other():
+            with deferred_tilemap_writes():
+                self.write_tile(other_info)
+
+        with deferred_tilemap_writes():
+            self.write_tile(info)
+            thread = threading.Thread(target=patch_other)
+            thread.start()
+            thread.join()
+            self.assertEqual(0x1234, BackgroundTilemap.from_info(other_info).tile_at(0, 0))
+            self.assertEqual([], rom.written_extents())
+        self.assertEqual(0x1234, BackgroundTilemap.from_info(info).tile_at(0, 0))
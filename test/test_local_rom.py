@@ -0,0 +1,201 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from ..patcher import ips
+from ..patcher.local_rom import FreeSpace, LocalRom, get_struct
+
+
+class MZMTestLocalRom(TestCase):
+    def test_written_extents(self):
+        rom = LocalRom(bytes(0x100))
+        rom.write(0x10, b"ab")
+        rom.write(0x20, b"cd")
+        rom.write(0x12, b"ef")
+        rom.write(0x40, b"")
+        self.assertEqual([(0x10, 0x14), (0x20, 0x22)], rom.written_extents())
+        rom.write(0x0, bytes(0x30))
+        self.assertEqual([(0x0, 0x30)], rom.written_extents())
+
+    def test_copy_on_write(self):
+        """Ensure writes are seen through the ROM but not saved to the file it was mapped from."""
+        data = bytes(range(256)) * 4
+        with tempfile.NamedTemporaryFile(delete=False) as file:
+            file.write(data)
+        try:
+            with LocalRom.copy_on_write(file.name) as rom:
+                rom.write(0x100, b"abc")
+                self.assertEqual(b"\xFFabc\x03", rom.read(0xFF, 5))
+                self.assertEqual(b"abc", rom.view(0x100)[:3])
+                self.assertEqual(data[:0x100] + b"abc" + data[0x103:], rom.to_bytes())
+                self.assertEqual([(0x100, 0x103)], rom.written_extents())
+                # Growing copies the ROM out of the file
+                self.assertEqual(len(data), rom.alloc(8))
+                rom.write(len(data) - 1, b"ab")
+                self.assertEqual(data[:0x100] + b"abc" + data[0x103:-1] + b"ab" + bytes(7), rom.to_bytes())
+            with open(file.name, "rb") as stream:
+                self.assertEqual(data, stream.read())
+        finally:
+            os.unlink(file.name)
+
+    def test_open_output(self):
+        data = bytes(range(256)) * 4
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "out.gba")
+            with LocalRom.open_output(path, data) as rom:
+                rom.write(0x100, b"abc")
+                self.assertEqual(b"abc", rom.read(0x100, 3))
+            with open(path, "rb") as stream:
+                self.assertEqual(data[:0x100] + b"abc" + data[0x103:], stream.read())
+            self.assertEqual(["out.gba"], os.listdir(directory))
+
+    def test_open_output_grows(self):
+        """Ensure the file grows when the ROM needs more space than it has."""
+        data = bytes(0x7F9E90)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "out.gba")
+            with LocalRom.open_output(path, data) as rom:
+                self.assertEqual(0x7F9E88, rom.alloc(6))
+                self.assertEqual(0x7F9E90, rom.alloc(8))
+                rom.write(0x7F9E90, b"abcdefgh")
+                rom.write(0x7F9E98, b"ijkl")
+            with open(path, "rb") as stream:
+                self.assertEqual(data + b"abcdefghijkl", stream.read())
+
+    def test_open_output_failure(self):
+        """Ensure nothing is left at the output path when patching fails."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "out.gba")
+            with self.assertRaises(KeyError):
+                with LocalRom.open_output(path, bytes(0x100)) as rom:
+                    rom.write(0, b"abc")
+                    raise KeyError
+            self.assertEqual([], os.listdir(directory))
+
+    def test_to_ips(self):
+        rom = LocalRom(bytes(0x100))
+        rom.write(0x10, b"ab")
+        rom.write(0x80, b"cde")
+        patch = rom.to_ips()
+        self.assertEqual(b"PATCH\x00\x00\x10\x00\x02ab\x00\x00\x80\x00\x03cdeEOF", patch)
+        self.assertEqual(rom.to_bytes(), ips.apply(bytes(0x100), patch))
+
+    def test_alloc_past_end(self):
+        rom = LocalRom(bytes(0x7F9E90))
+        self.assertEqual(0x7F9E88, rom.alloc(6))
+        self.assertEqual(0x7F9E90, rom.alloc(8))
+        self.assertEqual(0x7F9E98, len(rom.to_bytes()))
+
+    def test_alloc_extends_last_block(self):
+        """Ensure growing the ROM uses the free space already at its end."""
+        rom = LocalRom(bytes(0x7F9E90))
+        self.assertEqual(0x7F9E88, rom.alloc(0x10))
+        self.assertEqual(0x7F9E98, len(rom.to_bytes()))
+        self.assertEqual((0x10, 0x10, 0, 0), rom.space_report())
+
+    def test_append_dedup(self):
+        rom = LocalRom(bytes(0x7FA000))
+        first = rom.append(b"abc", dedup=True)
+        self.assertEqual(first, rom.append(b"abc", dedup=True))
+        self.assertNotEqual(first, rom.append(b"abc"))
+        self.assertNotEqual(first, rom.append(b"abcd", dedup=True))
+        # Data that was written over isn't reused
+        rom.write(first & 0x7FFFFFF, b"x")
+        self.assertNotEqual(first, rom.append(b"abc", dedup=True))
+
+    def test_typed_access(self):
+        rom = LocalRom(bytes(0x100))
+        rom.write_u32(0x10, 0x8001234)
+        rom.write_u16(0x14, 0xABCD)
+        rom.write_u8(0x16, 0x7F)
+        self.assertEqual(b"\x34\x12\x00\x08\xCD\xAB\x7F", rom.read(0x10, 7))
+        self.assertEqual(0x8001234, rom.read_u32(0x10))
+        self.assertEqual(0xABCD, rom.read_u16(0x14))
+        self.assertEqual(0x7F, rom.read_u8(0x16))
+        self.assertEqual((0x1234, 0x800, 0xABCD), rom.read(0x10, "<HHH"))
+
+        rom.write_struct("<BxH", 0x20, 1, 2)
+        self.assertEqual((1, 2), rom.read_struct(get_struct("<BxH"), 0x20))
+        self.assertIs(get_struct("<BxH"), get_struct("<BxH"))
+        self.assertEqual([(0x10, 0x17), (0x20, 0x24)], rom.written_extents())
+
+    def test_table(self):
+        rom = LocalRom(bytes(range(0x40)))
+        table = rom.table("<BH", 0x10, 4)
+        self.assertEqual((0x10, 0x1211), table[0])
+        table[1] = (1, 2)
+        table[3] = (3, 4)
+        self.assertFalse(table.is_full())
+        with self.assertRaises(IndexError):
+            table[4] = (0, 0)
+        # Nothing is written until the table is
+        self.assertEqual([], rom.written_extents())
+
+        table.fill(0xFF, 0xFFFF)
+        self.assertTrue(table.is_full())
+        table.write()
+        self.assertEqual(b"\xFF" * 3 + b"\x01\x02\x00" + b"\xFF" * 3 + b"\x03\x04\x00", rom.read(0x10, 12))
+        self.assertEqual([(0x10, 0x1C)], rom.written_extents())
+
+    def test_pointers_to(self):
+        rom = LocalRom(bytes(0x100))
+        rom.write(0x10, (0x8000080).to_bytes(4, "little"))
+        rom.write(0x21, (0x8000080).to_bytes(4, "little"))
+        rom.write(0x40, (0x8000080).to_bytes(4, "little"))
+        self.assertEqual([0x10, 0x40], rom.pointers_to(0x80))
+        self.assertEqual([0x40], rom.pointers_to(0x80, 0x14, 0x44))
+        self.assertEqual([], rom.pointers_to(0x80, 0x14, 0x43))
+
+
+class MZMTestFreeSpace(TestCase):
+    def test_best_fit(self):
+        space = FreeSpace(0x100, 0x200)
+        space.release(0x10, 0x20)
+        space.release(0x40, 0x8)
+        self.assertEqual(0x40, space.alloc(0x8))
+        self.assertEqual(0x10, space.alloc(0x10))
+        self.assertEqual(0x20, space.alloc(0x10))
+        self.assertEqual(0x100, space.alloc(0x10))
+        self.assertIsNone(space.alloc(0x100))
+
+    def test_alignment(self):
+        space = FreeSpace(0x101, 0x200)
+        self.assertEqual(0x102, space.alloc(3, 2))
+        self.assertEqual(0x108, space.alloc(4, 4))
+        self.assertEqual(0x101, space.alloc(1, 1))
+        self.assertEqual(0x105, space.alloc(1, 1))
+        self.assertEqual([0x106, 0x10C], space.starts)
+
+    def test_release(self):
+        """Ensure released space merges with the free space around it and is counted in the report."""
+        space = FreeSpace(0x100, 0x200)
+        a = space.alloc(0x10)
+        b = space.alloc(0x10)
+        space.alloc(0x10)
+        self.assertEqual((0x100, 0x30, 0xD0, 0xD0), space.report())
+        space.release(a, 0x10)
+        space.release(b, 0x10)
+        self.assertEqual([(0x100, 0x120), (0x130, 0x200)], list(zip(space.starts, space.ends)))
+        space.release(0x200, 0x40)
+        self.assertEqual([(0x100, 0x120), (0x130, 0x240)], list(zip(space.starts, space.ends)))
+        self.assertEqual((0x140, 0x10, 0x130, 0x110), space.report())
+        with self.assertRaises(AssertionError):
+            space.release(0x110, 0x8)
+
+
+class MZMTestIPS(TestCase):
+    def test_record_limits(self):
+        """Ensure long ranges are split and no record starts at the address that reads as the end of the patch."""
+        data = bytes(i % 251 + 1 for i in range(0x460000))
+        for start, end in ((0, 0x20000), (ips.EOF_ADDRESS, ips.EOF_ADDRESS + 1),
+                           (ips.EOF_ADDRESS - ips.MAX_RECORD_SIZE, ips.EOF_ADDRESS + 1),
+                           (ips.EOF_ADDRESS - ips.MAX_RECORD_SIZE - 1, ips.EOF_ADDRESS + 1)):
+            with self.subTest(start=start, end=end):
+                # A record at the end marker would end the patch early and leave the rest of the range unwritten
+                patched = ips.apply(bytes(len(data)), ips.create(data, [(start, end)]))
+                self.assertEqual(data[start:end], patched[start:end])
+
+    def test_truncated_patch(self):
+        patch = ips.create(bytes(0x10), [(0, 0x10)])
+        with self.assertRaises(ValueError):
+            ips.apply(bytes(0x10), patch[:-4])